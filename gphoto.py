@@ -3,24 +3,157 @@
 #Useful if you have photos in a directory structure 
 #that you want to reflect as Google Photos albums.
 
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.exceptions import RefreshError
+from google.auth.exceptions import RefreshError, TransportError
 from google.auth.transport.requests import AuthorizedSession
-from google.oauth2.credentials import Credentials
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectTimeout
+from urllib3.exceptions import NewConnectionError
+from urllib.parse import urlparse
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import json
 import os
 import os.path
+import queue
 import argparse
+import functools
+import hashlib
+import importlib.util
+import itertools
 import logging
+import mimetypes
+import random
 import re
+import select
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import subprocess
 import sys
-from pprint import pprint
-from pathlib import Path
+import tempfile
+import threading
+import time
+import weakref
+
+# Base URL of Google Photos Library API. Can be pointed elsewhere, for example
+# to test/mock_server.py, with GPHOTO_API_URL environment variable.
+API_URL = os.environ.get("GPHOTO_API_URL", "https://photoslibrary.googleapis.com/v1").rstrip('/')
+
+# Maximum number of upload tokens accepted by one mediaItems:batchCreate call.
+MAX_BATCH_CREATE = 50
+
+#gphotos can only deal with (according to docs):
+#Photos:	BMP, GIF, HEIC, ICO, JPG, PNG, TIFF, WEBP, some RAW files.	200 MB
+#Videos:	3GP, 3G2, ASF, AVI, DIVX, M2T, M2TS, M4V, MKV, MMV, MOD, MOV, MP4, MPG, MTS, TOD, WMV.	10 GB
+PHOTO_SIZE_LIMIT = 200 * 1024 * 1024
+VIDEO_SIZE_LIMIT = 10 * 1024 * 1024 * 1024
+PHOTO_EXTENSIONS = {'.bmp', '.gif', '.heic', '.ico', '.jpg', '.jpeg', '.png', '.tif', '.tiff', '.webp', '.raw'}
+VIDEO_EXTENSIONS = {'.3gp', '.3g2', '.asf', '.avi', '.divx', '.m2t', '.m2ts', '.m4v', '.mkv', '.mmv',
+                    '.mod', '.mov', '.mp4', '.mpg', '.mts', '.tod', '.wmv'}
+MEDIA_SIZE_LIMITS = dict([(ext, PHOTO_SIZE_LIMIT) for ext in PHOTO_EXTENSIONS] +
+                         [(ext, VIDEO_SIZE_LIMIT) for ext in VIDEO_EXTENSIONS])
+
+# Number of folders listed in parallel when scanning a folder tree.
+SCAN_JOBS = 4
+
+# Upload progress is redrawn every PROGRESS_REFRESH seconds on a terminal, or
+# logged every PROGRESS_LOG_INTERVAL seconds otherwise. Upload rate is averaged
+# over last PROGRESS_RATE_WINDOW seconds.
+PROGRESS_REFRESH = 0.5
+PROGRESS_LOG_INTERVAL = 30
+PROGRESS_RATE_WINDOW = 10
+
+# Capture times are read from file headers of DATE_SCAN_JOBS files at a time.
+# EXIF of a JPEG file is looked for only in segments that start in its first
+# CAPTURE_SCAN_LIMIT bytes. QuickTime times count seconds from 1904-01-01,
+# QUICKTIME_EPOCH seconds before 1970-01-01.
+DATE_SCAN_JOBS = 16
+CAPTURE_SCAN_LIMIT = 256 * 1024
+QUICKTIME_EPOCH = 2082844800
+ISO_BOX_TYPES = {b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip"}
+
+# HTTP connection pool and timeouts (in seconds). Credentials are refreshed
+# when they expire in less than TOKEN_REFRESH_MARGIN seconds, if that fails
+# while token is still valid it is tried again after TOKEN_REFRESH_RETRY.
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 120
+TOKEN_REFRESH_MARGIN = 5 * 60
+TOKEN_REFRESH_RETRY = 30
+
+# Upper bounds (in seconds) of latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float("inf"))
+
+# Requests failing with these status codes are retried with exponential
+# backoff, starting at RETRY_BASE_DELAY and capped at RETRY_MAX_DELAY seconds.
+# Throttling responses also lower number of requests in progress.
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+# Requests that create something, like album or media items, could have been
+# done by server before it failed. They are retried only on these, and on
+# connection errors before request was sent.
+UNSAFE_RETRY_STATUS_CODES = {429}
+MAX_RETRIES = 6
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 64.0
+AIMD_COOLDOWN = 5.0
+
+# Watch mode uploads a file once it has not changed for DEFAULT_SETTLE seconds.
+# Without inotify, folders are scanned every DEFAULT_POLL_INTERVAL seconds.
+DEFAULT_SETTLE = 5
+DEFAULT_POLL_INTERVAL = 30
+
+# With '--from-stdin', records that arrived while previous files were being
+# uploaded are uploaded together, at most this many at a time.
+STREAM_BATCH_SIZE = 1000
+
+# With '--workers', each worker process claims up to WORK_BATCH_SIZE files of
+# one album at a time for WORK_LEASE seconds, and keeps extending the lease
+# while it works on them. Files are given up on after MAX_WORK_ATTEMPTS.
+WORK_BATCH_SIZE = 50
+WORK_LEASE = 120
+MAX_WORK_ATTEMPTS = 3
+
+# Largest page size accepted when listing albums.
+ALBUM_PAGE_SIZE = 50
+
+# Files larger than one chunk are sent with resumable upload protocol, one
+# chunk at a time. Failed chunks are retried this many times in a row.
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CHUNK_RETRIES = 5
+
+# Uploads are scheduled in a lane of files sent whole and a lane of files sent
+# in chunks, each with workers of its own. Unless given, large file lane has a
+# worker for every LARGE_JOBS_RATIO small file workers, at least one. Files
+# are read ahead up to LANE_LOOKAHEAD files to find work for both lanes.
+UPLOAD_LANES = ("small", "large")
+LARGE_JOBS_RATIO = 4
+LANE_LOOKAHEAD = 1000
+
+# File contents held in memory by uploads in flight, counting one chunk of
+# each file sent in chunks, are kept under this many bytes.
+DEFAULT_MAX_IN_FLIGHT = 256 * 1024 * 1024
+
+# Downloads are streamed to disk in blocks of this size.
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+# Upload tokens are valid for a day, tokens of files that were uploaded but
+# not added to album are reused if younger than this (in seconds).
+UPLOAD_TOKEN_MAX_AGE = 20 * 60 * 60
+
+# With '--optimize', JPEG photos are downscaled to at most this many
+# megapixels, same as Google's "Storage saver", and saved with this quality.
+OPTIMIZE_EXTENSIONS = {".jpg", ".jpeg"}
+DEFAULT_OPTIMIZE_MEGAPIXELS = 16
+DEFAULT_OPTIMIZE_QUALITY = 85
 
 #TODO:
-# 1. Support cron run 
-# 2. Enhance support for uploading specific folder/specefic file 
+# 1. Enhance support for uploading specific folder/specefic file 
 
 
 def parse_args(arg_input=None):
@@ -35,8 +168,17 @@ any more.
 Examples:
   Create auth token: gphoto.py --auth
      Upload a photo: gphoto.py --up --album myalbum myphoto.jpeg
+  Upload album tree: gphoto.py --up --path myphotos
+   With 4 processes: gphoto.py --up --path myphotos --workers 4
+    Album per month: gphoto.py --up --path myphotos --album-by date:%Y-%m
+   Upload file list: find . -type f -printf 'myalbum\\t%p\\0' | gphoto.py --up -0
+ Keep tree uploaded: gphoto.py --watch myphotos
     List all albums: gphoto.py --ls
+     Update catalog: gphoto.py --refresh --jobs 4
+List albums offline: gphoto.py --ls --catalog
 List items in album: gphoto.py --ls --album myalbum
+     Download album: gphoto.py --down --album myalbum --dest backup/myalbum
+  All items, NDJSON: gphoto.py --ls --all --json --jobs 4
 
 ''')
     parser.add_argument('--auth ', dest='create_auth', action='store_true',
@@ -45,24 +187,97 @@ List items in album: gphoto.py --ls --album myalbum
                     help="File where client id and secret is stored. Used in combination with '--auth'. (optional, default is 'auth/client_id.json'")
     parser.add_argument('--token', metavar='token_file', dest='token_file',
                     help="File where authentication token is stored. (optional, default is 'auth/token.json'")
-#    parser.add_argument('--path ', metavar='root_folder', dest='root_folder', default='.',
-#                    help="Path to root of album album folders.")
+    parser.add_argument('--path', metavar='root_folder', dest='root_folder',
+                    help="Path to root of album folders. Used with '--up' to upload each folder under it into album of the same name.")
     parser.add_argument('--album', metavar='album_name', dest='album_name',
                     help="Name of photo album to create (if it doesn't exist). Any uploaded photos will be added to this album.")
+    parser.add_argument('--album-by', metavar='date:format', dest='album_by',
+                    help="Upload files into albums named by their capture time, read from EXIF or QuickTime header, in strftime format, e.g. 'date:%%Y-%%m'. Used with '--up' instead of '--album', files under '--path' are all grouped this way.")
+    parser.add_argument('--album-cache-ttl', metavar='seconds', dest='album_cache_ttl', type=int, default=0,
+                    help="Save list of albums to 'albums.json' next to token file and reuse it for this many seconds. (optional, default is 0, not saved)")
+    parser.add_argument('--stats', dest='print_stats', action='store_true',
+                    help="Print summary of time spent per phase and API calls per endpoint when done.")
+    parser.add_argument('--metrics-file', metavar='metrics_file', dest='metrics_file',
+                    help="Write metrics of the run to this file, in Prometheus text format if name ends with '.prom', otherwise JSON.")
     parser.add_argument('--log', metavar='log_file', dest='log_file',
                     help="Name of output file for log messages.")
     parser.add_argument('--up',dest='run_upload', action='store_true',
                     help="Run upload to gphoto.")
+    parser.add_argument('--watch', metavar='root_folder', dest='watch_folder',
+                    help="Keep running and upload new files under root of album folders, same as '--up --path', as soon as they are written.")
+    parser.add_argument('--settle', metavar='seconds', dest='settle', type=float, default=DEFAULT_SETTLE,
+                    help="Upload files in '--watch' mode once they did not change for this long. (optional, default is {})".format(DEFAULT_SETTLE))
+    parser.add_argument('--poll-interval', metavar='seconds', dest='poll_interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                    help="Scan folders this often in '--watch' mode where inotify is not available. (optional, default is {})".format(DEFAULT_POLL_INTERVAL))
+    parser.add_argument('-0', '--from-stdin', dest='from_stdin', action='store_true',
+                    help="Upload files listed on standard input as NUL separated 'album<TAB>path' records. Used in combination with '--up'.")
+    parser.add_argument('--down', dest='run_download', action='store_true',
+                    help="Download original files of album given with '--album' into '--dest' folder.")
+    parser.add_argument('--dest', metavar='dest_folder', dest='dest_folder',
+                    help="Folder to download into, created if it doesn't exist. Used in combination with '--down'.")
     parser.add_argument('--ls',dest='albums_list', action='store_true',
                     help="List all albums in gphoto. Combination with '--album' will list all items in album.")
-#    parser.add_argument('--exclude', metavar='exclude', dest='exclude',
-#                    help="Regex to exclude.")
+    parser.add_argument('--json', dest='json_output', action='store_true',
+                    help="Print listing as JSON, one album or media item per line. Used in combination with '--ls'.")
+    parser.add_argument('--all', dest='list_all', action='store_true',
+                    help="List content of all albums, '--jobs' albums at a time. Used in combination with '--ls'.")
+    parser.add_argument('--refresh', dest='refresh_catalog', action='store_true',
+                    help="Update local catalog of albums and their media items, 'catalog.db' next to token file. Content is listed again only of albums whose number of items changed.")
+    parser.add_argument('--catalog', dest='use_catalog', action='store_true',
+                    help="Use local catalog updated by '--refresh' instead of listing albums on server. With '--ls' albums are listed from it offline, with '--up' files whose name is already in album according to it are skipped.")
+    parser.add_argument('--jobs', metavar='N', dest='jobs', type=int, default=1,
+                    help="Number of files to upload or download, or albums to list or refresh, in parallel. (optional, default is 1)")
+    parser.add_argument('--max-albums-in-flight', metavar='N', dest='max_albums_in_flight', type=int, default=1,
+                    help="Number of albums uploaded at the same time, sharing '--jobs' workers. Used in combination with '--path', '--watch' or '--from-stdin'. (optional, default is 1)")
+    parser.add_argument('--large-jobs', metavar='N', dest='large_jobs', type=int, default=0,
+                    help="Number of files larger than '--chunk-size' to upload in parallel, by workers of their own in addition to '--jobs', so they don't hold up smaller files. (optional, default is 0, a quarter of '--jobs' but at least 1)")
+    parser.add_argument('--max-in-flight', metavar='MB', dest='max_in_flight', type=int, default=DEFAULT_MAX_IN_FLIGHT // (1024 * 1024),
+                    help="Largest total size of file contents held in memory by uploads in parallel, counting one chunk of each file uploaded in chunks. (optional, default is 256)")
+    parser.add_argument('--workers', metavar='N', dest='workers', type=int, default=0,
+                    help="Upload with N worker processes sharing a work queue. Used in combination with '--path'. (optional, default is 0, upload in this process)")
+    parser.add_argument('--queue', metavar='queue_file', dest='queue_file',
+                    help="Work queue database of '--workers'. Given without '--path', runs one more worker of that queue. (optional, default is 'queue.db' next to token file)")
+    parser.add_argument('--worker-token', metavar='token_file', dest='worker_tokens', action='append',
+                    help="Token file for worker processes, given once for each account, workers use them in turn. Used in combination with '--workers'. (optional, default is '--token')")
+    parser.add_argument('--rpm', metavar='N', dest='rpm', type=int, default=0,
+                    help="Maximum number of API requests per minute. (optional, default is 0, no limit)")
+    parser.add_argument('--bandwidth', metavar='MB/s', dest='bandwidth', type=float, default=0,
+                    help="Maximum upload bandwidth, shared by all uploads. (optional, default is 0, no limit)")
+    parser.add_argument('--bandwidth-schedule', metavar='HH:MM-HH:MM[=MB/s],...', dest='bandwidth_schedule',
+                    help="Times of day when upload bandwidth is limited, to '--bandwidth' or to rate given for the time, and is not limited at other times. (optional, default is all day)")
+    parser.add_argument('--no-progress', dest='show_progress', action='store_false',
+                    help="Don't show progress of upload. Progress is shown on a line below output on a terminal, otherwise it is logged every {} seconds.".format(PROGRESS_LOG_INTERVAL))
+    parser.add_argument('--connect-timeout', metavar='seconds', dest='connect_timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT,
+                    help="Timeout for connecting to server. (optional, default is {})".format(DEFAULT_CONNECT_TIMEOUT))
+    parser.add_argument('--read-timeout', metavar='seconds', dest='read_timeout', type=float, default=DEFAULT_READ_TIMEOUT,
+                    help="Timeout for server response. (optional, default is {})".format(DEFAULT_READ_TIMEOUT))
+    parser.add_argument('--upload-timeout', metavar='seconds', dest='upload_timeout', type=float, default=0,
+                    help="Time limit for upload of one file. (optional, default is 0, no limit)")
+    parser.add_argument('--chunk-size', metavar='MB', dest='chunk_size', type=int, default=DEFAULT_CHUNK_SIZE // (1024 * 1024),
+                    help="Files larger than this are uploaded in chunks of this size and can be resumed. (optional, default is 8)")
+    parser.add_argument('--state', metavar='state_file', dest='state_file',
+                    help="Database file where uploaded files are recorded, so they are skipped on next run. (optional, default is 'state.db' next to token file)")
+    parser.add_argument('--hash', dest='hash_files', action='store_true',
+                    help="Record content hash of uploaded files and skip files whose content is already uploaded to album. Files whose content is already uploaded to another album are added to album without uploading them again.")
+    parser.add_argument('--optimize', dest='optimize', action='store_true',
+                    help="Downscale and recompress JPEG photos before upload, keeping EXIF. Needs Pillow ('pip install Pillow').")
+    parser.add_argument('--max-megapixels', metavar='MP', dest='max_megapixels', type=float, default=DEFAULT_OPTIMIZE_MEGAPIXELS,
+                    help="Largest size of optimized photos. Used in combination with '--optimize'. (optional, default is {})".format(DEFAULT_OPTIMIZE_MEGAPIXELS))
+    parser.add_argument('--quality', metavar='N', dest='quality', type=int, default=DEFAULT_OPTIMIZE_QUALITY,
+                    help="JPEG quality of optimized photos, 1 to 95. Used in combination with '--optimize'. (optional, default is {})".format(DEFAULT_OPTIMIZE_QUALITY))
+    parser.add_argument('--reconcile', dest='reconcile', action='store_true',
+                    help="List album content and record files already in album as uploaded.")
+    parser.add_argument('--exclude', metavar='exclude', dest='exclude',
+                    help="Regex to exclude. Files and folders whose path matches are not uploaded. Used in combination with '--path' or '--watch'.")
     parser.add_argument('photos', metavar='photo',type=str, nargs='*',
                     help="filename of a photo to upload")
     return parser.parse_args(arg_input)
 
 
 def auth(client_id_file, scopes):
+    # Only needed to create auth token, and slow to import.
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     flow = InstalledAppFlow.from_client_secrets_file(
         client_id_file,
         scopes=scopes)
@@ -76,11 +291,95 @@ def auth(client_id_file, scopes):
     return credentials
 
 
-def get_authorized_session(client_id_file, token_file):
+# AuthorizedSession with a connection pool sized for upload workers and
+# default (connect, read) timeouts. Credentials are refreshed by one thread,
+# under a lock, shortly before they expire or once after a 401 response, and
+# refreshed credentials are saved to token_file for next process.
+class PhotosSession(AuthorizedSession):
+
+    def __init__(self, credentials, token_file=None, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT), upload_timeout=None):
+        # 401 responses are handled here, so concurrent requests don't each refresh.
+        super().__init__(credentials, refresh_status_codes=())
+        self.token_file = token_file
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout
+        self.refresh_lock = threading.Lock()
+        self.refresh_retry_at = 0
+
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+
+        token = self.refresh_credentials()
+        resp = super().request(method, url, data=data, headers=headers, **kwargs)
+
+        if resp.status_code == 401 and self.credentials.refresh_token:
+            self.refresh_credentials(stale_token=token)
+            # Upload body was already read by first request.
+            if hasattr(data, "seek"):
+                data.seek(0)
+            resp = super().request(method, url, data=data, headers=headers, **kwargs)
+
+        return resp
+
+    def _needs_refresh(self, stale_token):
+        cred = self.credentials
+        if not cred.refresh_token:
+            return False
+        if stale_token is not None:
+            return cred.token == stale_token
+        expires_in = self._expires_in()
+        if expires_in is None or expires_in <= 0:
+            return True
+        return expires_in < TOKEN_REFRESH_MARGIN and time.monotonic() >= self.refresh_retry_at
+
+    # Seconds until token expires, None if there is no token or its expiry is
+    # unknown.
+    def _expires_in(self):
+        cred = self.credentials
+        if cred.token is None or cred.expiry is None:
+            return None
+        return (cred.expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+
+    # Refresh credentials if they expire within TOKEN_REFRESH_MARGIN seconds,
+    # or if token is still stale_token. Returns token to use. Refresh errors
+    # are raised only if token expired or was rejected, otherwise the current
+    # token is used until refresh is tried again.
+    def refresh_credentials(self, stale_token=None):
+        if self._needs_refresh(stale_token):
+            with self.refresh_lock:
+                if self._needs_refresh(stale_token):
+                    logging.info("Refreshing credentials")
+                    try:
+                        self.credentials.refresh(self._auth_request)
+                    except (RefreshError, TransportError) as err:
+                        expires_in = self._expires_in()
+                        if stale_token is not None or expires_in is None or expires_in <= 0:
+                            raise
+                        logging.warning("Could not refresh credentials, token is valid for {:.0f} more seconds -- {}".format(expires_in, err))
+                        self.refresh_retry_at = time.monotonic() + TOKEN_REFRESH_RETRY
+                        return self.credentials.token
+                    logging.debug("Credentials refreshed, valid until {} UTC".format(self.credentials.expiry))
+                    if self.token_file:
+                        try:
+                            save_cred(self.credentials, self.token_file)
+                        except OSError as err:
+                            logging.error("Could not save auth tokens - {0}".format(err))
+        return self.credentials.token
+
+
+def get_authorized_session(client_id_file, token_file, pool_size=DEFAULT_POOL_SIZE,
+                           timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT), upload_timeout=None):
     scopes=['https://www.googleapis.com/auth/photoslibrary',
             'https://www.googleapis.com/auth/photoslibrary.sharing',
             'https://www.googleapis.com/auth/photoslibrary.edit.appcreateddata']
 
+    from google.oauth2.credentials import Credentials
+
     cred = None
 
     try:
@@ -92,8 +391,12 @@ def get_authorized_session(client_id_file, token_file):
 
     # Create session and return if saved credentials already exist.
     if cred is not None:
-        session = AuthorizedSession(cred)
+        session = PhotosSession(cred, token_file, pool_size, timeout, upload_timeout)
         return session
+
+    # Without client id file there is no way to create credentials.
+    if client_id_file is None:
+        return None
         
     try:
         # If saved credentials do not exist, try to create them and save for later.
@@ -105,10 +408,26 @@ def get_authorized_session(client_id_file, token_file):
         logging.error("Could not load/save auth tokens - {0}".format(err))
         return None
 
-    session = AuthorizedSession(cred)
+    session = PhotosSession(cred, token_file, pool_size, timeout, upload_timeout)
     return session
 
 
+# Write text to file_name through a temporary file, so other processes never
+# read half a file. Raises OSError.
+def writeFileAtomically(file_name, text):
+    tmp_file = "{}.{}.tmp".format(file_name, os.getpid())
+    try:
+        with open(tmp_file, 'w') as f:
+            f.write(text)
+        os.replace(tmp_file, file_name)
+    except OSError:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+
+
 def save_cred(cred, auth_file):
 
     cred_dict = {
@@ -121,34 +440,548 @@ def save_cred(cred, auth_file):
         'client_secret': cred.client_secret
     }
 
-    with open(auth_file, 'w') as f:
-        print(json.dumps(cred_dict), file=f)
+    # Without expiry, next process would have to refresh token before first request.
+    if cred.expiry:
+        cred_dict['expiry'] = cred.expiry.isoformat() + 'Z'
+
+    writeFileAtomically(auth_file, json.dumps(cred_dict) + "\n")
+
+# Counters and latency histograms of a run, shared by all threads. Phases of
+# work are timed into "phase_seconds" histogram, API calls into
+# "api_latency_seconds", both can be printed as summary or written as JSON or
+# Prometheus text file.
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    @contextmanager
+    def timer(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe("phase_seconds", time.monotonic() - start, phase=phase)
+
+    def value(self, name, **labels):
+        with self.lock:
+            return sum(v for (n, l), v in self.counters.items() if n == name and set(labels.items()) <= set(l))
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "started": self.started,
+                "elapsed": time.time() - self.started,
+                "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.counters.items())],
+                "histograms": [{"name": n, "labels": dict(l), "buckets": dict(zip(LATENCY_BUCKETS, h["buckets"])),
+                                "sum": h["sum"], "count": h["count"]} for (n, l), h in sorted(self.histograms.items())]
+            }
+
+    def to_prometheus(self):
+        def labels_text(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + "}"
+
+        lines = []
+        data = self.to_dict()
+        typed = set()
+
+        for c in data["counters"]:
+            name = "gphoto_" + c["name"] + "_total"
+            if name not in typed:
+                lines.append("# TYPE {} counter".format(name))
+                typed.add(name)
+            lines.append("{}{} {}".format(name, labels_text(c["labels"].items()), c["value"]))
+
+        for h in data["histograms"]:
+            name = "gphoto_" + h["name"]
+            if name not in typed:
+                lines.append("# TYPE {} histogram".format(name))
+                typed.add(name)
+            for bound, count in h["buckets"].items():
+                lines.append("{}_bucket{} {}".format(name, labels_text(h["labels"].items(), [("le", "+Inf" if bound == float("inf") else bound)]), count))
+            lines.append("{}_sum{} {}".format(name, labels_text(h["labels"].items()), h["sum"]))
+            lines.append("{}_count{} {}".format(name, labels_text(h["labels"].items()), h["count"]))
+
+        lines.append("# TYPE gphoto_run_seconds gauge")
+        lines.append("gphoto_run_seconds {}".format(data["elapsed"]))
+        lines.append("# TYPE gphoto_run_started_seconds gauge")
+        lines.append("gphoto_run_started_seconds {}".format(data["started"]))
+        return "\n".join(lines) + "\n"
+
+    # Write metrics to file, as Prometheus text file if name ends with '.prom'
+    # and as JSON otherwise. File is replaced at once, so readers never see
+    # half of it.
+    def write(self, file_name):
+        text = self.to_prometheus() if file_name.endswith(".prom") else json.dumps(self.to_dict(), indent=4)
+        writeFileAtomically(file_name, text if text.endswith("\n") else text + "\n")
+
+    def summary(self):
+        data = self.to_dict()
+        lines = ["Run time: {:.1f}s".format(data["elapsed"])]
+
+        lines.append("Files: {} uploaded, {} reused, {} skipped, {} failed; {:.1f} MB sent, {:.1f} MB not sent again".format(
+            self.value("files", result="uploaded"), self.value("files", result="reused"), self.value("files", result="skipped"),
+            self.value("files", result="failed"), self.value("bytes_sent") / (1024 * 1024), self.value("bytes_reused") / (1024 * 1024)))
+
+        downloaded = self.value("files", result="downloaded")
+        if downloaded:
+            lines.append("Downloaded: {} files; {:.1f} MB received".format(downloaded, self.value("bytes_received") / (1024 * 1024)))
+
+        optimized = self.value("files_optimized")
+        if optimized:
+            saved = self.value("bytes_saved") / (1024 * 1024)
+            lines.append("Optimized: {} files; {:.1f} MB saved, {:.2f} MB per file".format(optimized, saved, saved / optimized))
+
+        lines.append("{:<28} | {:>8} | {:>10} | {:>8}".format("PHASE", "COUNT", "TOTAL S", "AVG S"))
+        for h in data["histograms"]:
+            if h["name"] == "phase_seconds":
+                lines.append("{:<28} | {:>8} | {:>10.2f} | {:>8.3f}".format(h["labels"]["phase"], h["count"], h["sum"], h["sum"] / h["count"]))
+
+        lines.append("{:<28} | {:>8} | {:>10} | {:>8}".format("API ENDPOINT", "CALLS", "RETRIES", "AVG S"))
+        for h in data["histograms"]:
+            if h["name"] == "api_latency_seconds":
+                endpoint = h["labels"]["endpoint"]
+                lines.append("{:<28} | {:>8} | {:>10} | {:>8.3f}".format(endpoint, h["count"], self.value("api_retries", endpoint=endpoint), h["sum"] / h["count"]))
+
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+
+# Progress of uploads: files and bytes done out of those found by scan, current
+# upload rate and time left. Shown by a background thread between start and
+# stop, on a line redrawn below other output when stdout is a terminal, or
+# logged every PROGRESS_LOG_INTERVAL seconds otherwise.
+class Progress:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.output_lock = threading.Lock()
+        self.total_files = 0
+        self.total_bytes = 0
+        self.done_files = 0
+        self.done_bytes = 0
+        self.sent_bytes = 0
+        # Bytes sent so far of file being uploaded, per upload thread.
+        self.in_flight = {}
+        self.samples = deque()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.terminal = False
+        self.current = ""
+        self.shown = False
+        self.line_start = True
+
+    # Called by scan for every file found.
+    def add_total(self, size):
+        with self.lock:
+            self.total_files += 1
+            self.total_bytes += size
+
+    # Called for every block of upload sent, on thread uploading the file.
+    def sent(self, count):
+        ident = threading.get_ident()
+        with self.lock:
+            self.sent_bytes += count
+            self.in_flight[ident] = self.in_flight.get(ident, 0) + count
+
+    # Called once a file is uploaded, skipped or failed, on thread that
+    # uploaded it.
+    def file_done(self, size):
+        with self.lock:
+            self.done_files += 1
+            self.done_bytes += size
+            self.in_flight.pop(threading.get_ident(), None)
+
+    # Set counts of the whole run at once, for files uploaded by worker
+    # processes. Bytes done since previous call count as sent.
+    def set_counts(self, total_files, total_bytes, done_files, done_bytes):
+        with self.lock:
+            if self.done_files:
+                self.sent_bytes += max(0, done_bytes - self.done_bytes)
+            self.total_files, self.total_bytes = total_files, total_bytes
+            self.done_files, self.done_bytes = done_files, done_bytes
+
+    def status(self):
+        with self.lock:
+            now = time.monotonic()
+            self.samples.append((now, self.sent_bytes))
+            while len(self.samples) > 2 and now - self.samples[1][0] >= PROGRESS_RATE_WINDOW:
+                self.samples.popleft()
+            since, sent_bytes = self.samples[0]
+            rate = (self.sent_bytes - sent_bytes) / (now - since) if now > since else 0
+            done_bytes = self.done_bytes + sum(self.in_flight.values())
+            done_files, total_files, total_bytes = self.done_files, self.total_files, self.total_bytes
+
+        megabyte = 1024 * 1024
+        if not total_files:
+            return "Files: {} done; {:.1f} MB; {:.2f} MB/s".format(done_files, done_bytes / megabyte, rate / megabyte)
+
+        done_bytes = min(done_bytes, total_bytes)
+        if done_bytes == total_bytes:
+            eta = timedelta(0)
+        elif rate > 0:
+            eta = timedelta(seconds=int((total_bytes - done_bytes) / rate))
+        else:
+            eta = "-:--:--"
+        return "Files: {}/{}; {:.1f}/{:.1f} MB ({:.0f}%); {:.2f} MB/s; ETA {}".format(
+            done_files, total_files, done_bytes / megabyte, total_bytes / megabyte,
+            100.0 * done_bytes / total_bytes if total_bytes else 100, rate / megabyte, eta)
+
+    def start(self, terminal):
+        self.terminal = terminal
+        if terminal:
+            # Everything written to terminal goes through write, so progress
+            # line can be cleared first and drawn again below.
+            self.streams = (sys.stdout, sys.stderr)
+            sys.stdout, sys.stderr = ProgressOutput(self, sys.stdout), ProgressOutput(self, sys.stderr)
+            self.handlers = []
+            for handler in logging.getLogger().handlers:
+                if type(handler) is logging.StreamHandler and handler.stream in self.streams:
+                    self.handlers.append((handler, handler.setStream(ProgressOutput(self, handler.stream))))
+
+        with self.lock:
+            self.samples = deque([(time.monotonic(), self.sent_bytes)])
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(PROGRESS_REFRESH if self.terminal else PROGRESS_LOG_INTERVAL):
+            status = self.status()
+            if self.terminal:
+                with self.output_lock:
+                    self.current = status
+                    self.draw()
+            else:
+                logging.info("Progress -- {}".format(status))
+
+    # Stop showing progress, status of the end of run is printed or logged
+    # once more.
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
 
-# Generator to loop through all albums
-def getAlbums(session, appCreatedOnly=False):
+        status = self.status()
+        if not self.terminal:
+            logging.info("Progress -- {}".format(status))
+            return
+
+        with self.output_lock:
+            sys.stdout, sys.stderr = self.streams
+            for handler, stream in self.handlers:
+                handler.setStream(stream)
+            self.clear()
+            print(status if self.line_start else "\n" + status, file=self.streams[0], flush=True)
+
+    def clear(self):
+        if self.shown:
+            self.streams[0].write("\r\x1b[K")
+            self.streams[0].flush()
+            self.shown = False
+
+    def draw(self):
+        if self.line_start and self.current:
+            self.streams[0].write("\r" + self.current + "\x1b[K")
+            self.streams[0].flush()
+            self.shown = True
+
+    # Write text to stream above progress line. Progress line is drawn again
+    # once text ends a line.
+    def write(self, stream, text):
+        with self.output_lock:
+            self.clear()
+            stream.write(text)
+            stream.flush()
+            if text:
+                self.line_start = text.endswith("\n")
+            self.draw()
+        return len(text)
+
+
+# Terminal stream replaced while progress is shown, see Progress.start.
+class ProgressOutput:
+
+    def __init__(self, progress, stream):
+        self.progress = progress
+        self.stream = stream
+
+    def write(self, text):
+        return self.progress.write(self.stream, text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+progress = Progress()
+
+
+# Endpoint of a request for metrics, e.g. "POST /mediaItems:batchCreate", with ids left out.
+def endpoint_name(method, url):
+    path = url[len(API_URL):] if url.startswith(API_URL) else urlparse(url).path
+    path = re.sub(r"/(uploads|mediaItems|albums)/[^/:?]+", r"/\1/{id}", path.split('?')[0])
+    return "{} {}".format(method, path)
+
+
+# Limits rate of requests to requests_per_minute, with bursts of up to one
+# second worth of requests.
+class TokenBucket:
+
+    def __init__(self, requests_per_minute):
+        self.lock = threading.Lock()
+        self.rate = requests_per_minute / 60.0
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+# Limits number of requests in progress. Limit is halved when server throttles
+# (at most once per AIMD_COOLDOWN seconds) and raised by one after 'limit'
+# requests in a row went through, up to max_limit.
+class AdaptiveConcurrency:
+
+    def __init__(self, max_limit):
+        self.cond = threading.Condition()
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.active = 0
+        self.successes = 0
+        self.last_decrease = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, throttled):
+        with self.cond:
+            self.active -= 1
+            if throttled:
+                self.successes = 0
+                now = time.monotonic()
+                if self.limit > 1 and (now - self.last_decrease) > AIMD_COOLDOWN:
+                    self.limit = max(1, self.limit // 2)
+                    self.last_decrease = now
+                    logging.warning("Server is throttling requests, lowering concurrency to {}".format(self.limit))
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+                    logging.debug("Raising concurrency to {}".format(self.limit))
+            self.cond.notify_all()
+
+
+# Limits bytes sent by uploads of all threads to bytes_per_second, with bursts
+# of up to one second worth of bytes. If schedule is given, as a list of
+# (start, end, bytes_per_second) with times in minutes after local midnight,
+# the limit of the window current time is in applies instead, and there is no
+# limit outside of windows. Window whose end is before its start goes past
+# midnight.
+class BandwidthLimiter:
+
+    def __init__(self, bytes_per_second, schedule=None):
+        self.lock = threading.Lock()
+        self.bytes_per_second = bytes_per_second
+        self.schedule = schedule
+        self.allowance = 0.0
+        self.updated = time.monotonic()
+
+    def current_rate(self):
+        if not self.schedule:
+            return self.bytes_per_second
+
+        now = datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if start <= minute < end or (end <= start and (minute >= start or minute < end)):
+                return rate
+        return 0
+
+    # Wait until count bytes can be sent. Threads go into debt and sleep it
+    # off, so bytes of all threads together are sent at the limit.
+    def acquire(self, count):
+        rate = self.current_rate()
+        if not rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(rate, self.allowance + (now - self.updated) * rate) - count
+            self.updated = now
+            delay = -self.allowance / rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Shared by all requests made by this process, see configureRateLimits and
+# configureBandwidth.
+_rate_limiter = None
+_concurrency = None
+_bandwidth = None
+
+
+# Limit requests to requests_per_minute (0 is no limit) and to at most
+# max_concurrency requests in progress, lowered while server throttles.
+def configureRateLimits(requests_per_minute, max_concurrency):
+    global _rate_limiter, _concurrency
+    _rate_limiter = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+    _concurrency = AdaptiveConcurrency(max_concurrency) if max_concurrency > 0 else None
+
+
+# Limit bytes sent by uploads to megabytes_per_second (0 is no limit), or to
+# limits of schedule from parseSchedule during its windows only.
+def configureBandwidth(megabytes_per_second, schedule=None):
+    global _bandwidth
+    megabyte = 1024 * 1024
+    if schedule:
+        _bandwidth = BandwidthLimiter(megabytes_per_second * megabyte,
+                                      [(start, end, (rate or megabytes_per_second) * megabyte) for start, end, rate in schedule])
+    else:
+        _bandwidth = BandwidthLimiter(megabytes_per_second * megabyte) if megabytes_per_second > 0 else None
+
+
+# Parse comma separated 'HH:MM-HH:MM' windows of time of day, each optionally
+# followed by '=MB/s', into list of (start, end, MB/s or None) with times in
+# minutes after midnight. Raises ValueError if text is not a valid schedule.
+def parseSchedule(text):
+    schedule = []
+    for window in text.split(","):
+        times, _, rate = window.partition("=")
+        start, end = [datetime.strptime(t.strip(), "%H:%M") for t in times.split("-")]
+        rate = float(rate) if rate.strip() else None
+        if rate is not None and rate <= 0:
+            raise ValueError("expected positive rate in '{}'".format(window))
+        schedule.append((start.hour * 60 + start.minute, end.hour * 60 + end.minute, rate))
+    return schedule
+
+
+# Seconds to wait before retry number 'attempt' (counted from 0). Server's
+# Retry-After is respected, otherwise exponential backoff with full jitter.
+def retry_delay(attempt, resp=None):
+    retry_after = resp.headers.get("Retry-After") if resp is not None and hasattr(resp, "headers") else None
+    if retry_after:
+        try:
+            return float(retry_after) + random.uniform(0, 1)
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+# True if request failed before it was sent, connection to server could not
+# be made.
+def request_not_sent(err):
+    if isinstance(err, ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], "reason", None) if err.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+# Every request to API goes through here. Requests are rate limited and
+# retried with backoff on network errors and on 429/5xx responses. Returns
+# last response, or raises last network error, when retries run out.
+# Requests that are not idempotent are retried only when server surely did
+# not act on them, see UNSAFE_RETRY_STATUS_CODES. Endpoint names request in
+# metrics, if url is not an API endpoint.
+def api_request(session, method, url, max_retries=MAX_RETRIES, endpoint=None, idempotent=True, **kwargs):
+    endpoint = endpoint or endpoint_name(method, url)
+    retry_status_codes = RETRY_STATUS_CODES if idempotent else UNSAFE_RETRY_STATUS_CODES
+    attempt = 0
+    while True:
+        # Upload body is read again from its start on retry.
+        if hasattr(kwargs.get("data"), "seek"):
+            kwargs["data"].seek(0)
+        if _rate_limiter:
+            _rate_limiter.acquire()
+        if _concurrency:
+            _concurrency.acquire()
+
+        resp = None
+        start = time.monotonic()
+        try:
+            resp = session.request(method, url, **kwargs)
+        except OSError as err:
+            if attempt >= max_retries or not (idempotent or request_not_sent(err)):
+                raise
+            reason = err
+        finally:
+            if _concurrency:
+                _concurrency.release(resp is not None and resp.status_code in THROTTLE_STATUS_CODES)
+            metrics.observe("api_latency_seconds", time.monotonic() - start, endpoint=endpoint)
+            metrics.count("api_calls", endpoint=endpoint, code=str(resp.status_code) if resp is not None else "error")
+
+        if resp is not None:
+            if resp.status_code not in retry_status_codes or attempt >= max_retries:
+                return resp
+            reason = "{} {}".format(resp.status_code, resp.reason)
+            resp.close()
+
+        delay = retry_delay(attempt, resp)
+        metrics.count("api_retries", endpoint=endpoint)
+        logging.warning("Retrying {} {} in {:.1f}s -- {}".format(method, url.split('?')[0], delay, reason))
+        time.sleep(delay)
+        attempt += 1
+
+
+# Generator of pages of albums, each a list of albums. Raises RefreshError,
+# OSError, or ValueError with error of server response, if a page can't be
+# listed.
+def getAlbumPages(session, appCreatedOnly=False):
 
     params = {
-            'excludeNonAppCreatedData': appCreatedOnly
+            'excludeNonAppCreatedData': appCreatedOnly,
+            'pageSize': ALBUM_PAGE_SIZE
     }
 
     while True:
 
-        try:
-            albums = session.get('https://photoslibrary.googleapis.com/v1/albums', params=params).json()
-        except (RefreshError) as err:
-            # Relevant for this error: https://stackoverflow.com/a/59202851/852428
-            logging.error("google.auth.exception - RefreshError - {0}".format(err))
-            print("NOTE: When RefreshError happens you likely need to delete and request token again.")
-            return None
-        except OSError as err:
-            logging.error("Failed to list albums - {0}".format(err))
-            return None
+        albums = api_request(session, 'GET', API_URL + '/albums', params=params).json()
 
         if 'albums' in albums:
             logging.debug("Server response: {}".format(albums))
 
-            for a in albums["albums"]:
-                yield a
+            yield albums["albums"]
 
             if 'nextPageToken' in albums:
                 params["pageToken"] = albums["nextPageToken"]
@@ -156,172 +989,1509 @@ def getAlbums(session, appCreatedOnly=False):
                 return
 
         elif "error" in albums:
-            error = albums["error"]
-            if "code" in error and "message" in error and "status" in error:
-                logging.debug("Server response: {}".format(albums))
-                print("error: {}; {}; {}".format(error["code"], error["status"], error["message"]))
-            else:
-                logging.error("Server response: {}".format(albums))
-                
-            return None
-        
+            raise ValueError(albums["error"])
+
         else:
             return
 
-def getAlbumId(session, album_name, app_created_only=False):
 
-    params = {
-            'excludeNonAppCreatedData': app_created_only
-    }
+# Generator to loop through all albums, stops early if albums can't be listed.
+def getAlbums(session, appCreatedOnly=False):
+    try:
+        for page in getAlbumPages(session, appCreatedOnly):
+            yield from page
+    except (RefreshError) as err:
+        # Relevant for this error: https://stackoverflow.com/a/59202851/852428
+        logging.error("google.auth.exception - RefreshError - {0}".format(err))
+        logging.error("NOTE: When RefreshError happens you likely need to delete and request token again.")
+    except OSError as err:
+        logging.error("Failed to list albums - {0}".format(err))
+    except ValueError as err:
+        error = err.args[0]
+        if isinstance(error, dict) and "code" in error and "message" in error and "status" in error:
+            logging.debug("Server response: {}".format(error))
+            logging.error("Failed to list albums - {}; {}; {}".format(error["code"], error["status"], error["message"]))
+        else:
+            logging.error("Server response: {}".format(error))
+
+# Album title -> id index, built from one listing of albums and kept current
+# when this app creates an album. Listings of app created albums and of all
+# albums are kept apart. If cache_file is given, listings are also saved to
+# disk and reused by next process for ttl seconds.
+class AlbumIndex:
+
+    def __init__(self, cache_file=None, ttl=0):
+        self.lock = threading.RLock()
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.albums = {}
+        self.listed = {}
+        self.from_disk = set()
+
+    @staticmethod
+    def _kind(app_created_only):
+        return "app" if app_created_only else "all"
+
+    def _load(self, session, kind):
+        if kind in self.albums:
+            return self.albums[kind]
+
+        if self.cache_file and self.ttl > 0:
+            try:
+                with open(self.cache_file) as f:
+                    entry = json.load(f).get(kind)
+                if entry and (time.time() - entry["time"]) < self.ttl:
+                    self.albums[kind] = entry["albums"]
+                    self.listed[kind] = entry["time"]
+                    self.from_disk.add(kind)
+                    logging.debug("Loaded {} albums from cache \'{}\'".format(len(entry["albums"]), self.cache_file))
+                    return self.albums[kind]
+            except OSError:
+                pass
+            except (ValueError, KeyError, AttributeError):
+                logging.warning("Ignoring album cache \'{}\' -- Incorrect format".format(self.cache_file))
+
+        return self.refresh(session, kind == "app")
+
+    # List albums on server again and replace what is in the index.
+    def refresh(self, session, app_created_only=False):
+        kind = self._kind(app_created_only)
+        with self.lock, metrics.timer("album_list"):
+            self.albums[kind] = {a["title"]: a["id"] for a in getAlbums(session, app_created_only) if "title" in a}
+            self.listed[kind] = time.time()
+            self.from_disk.discard(kind)
+            self._save()
+            return self.albums[kind]
+
+    def _match(self, albums, title, ignore_case):
+        if title in albums:
+            return albums[title]
+        if ignore_case:
+            for t, album_id in albums.items():
+                if t.lower() == title.lower():
+                    return album_id
+        return None
 
-    while True:
+    # Returns id of album with given title or None. On a miss in a listing
+    # that came from disk cache, albums are listed from server once more.
+    def find(self, session, title, app_created_only=False, ignore_case=False):
+        kind = self._kind(app_created_only)
+        with self.lock:
+            album_id = self._match(self._load(session, kind), title, ignore_case)
+            if album_id is None and kind in self.from_disk:
+                album_id = self._match(self.refresh(session, app_created_only), title, ignore_case)
+            return album_id
 
-        albums = session.get('https://photoslibrary.googleapis.com/v1/albums', params=params).json()
+    # Record album created by this app, it belongs to both listings.
+    def add(self, title, album_id):
+        with self.lock:
+            for albums in self.albums.values():
+                albums[title] = album_id
+            self._save({title: album_id})
+
+    # Save listings of this process to cache file, listings it didn't load
+    # are kept as they are on disk, with added albums too.
+    def _save(self, added=None):
+        if not self.cache_file or self.ttl <= 0:
+            return
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            if not isinstance(cache, dict):
+                cache = {}
+        except (OSError, ValueError):
+            cache = {}
+        for kind, entry in list(cache.items()):
+            if kind in self.albums:
+                continue
+            if not isinstance(entry, dict) or not isinstance(entry.get("albums"), dict):
+                del cache[kind]
+            elif added:
+                entry["albums"].update(added)
+        cache.update({kind: {"time": self.listed[kind], "albums": albums} for kind, albums in self.albums.items()})
+        try:
+            writeFileAtomically(self.cache_file, json.dumps(cache) + "\n")
+        except OSError as err:
+            logging.error("Could not save album cache -- {0}".format(err))
 
-        if 'albums' in albums:
-            logging.debug("Server response: {}".format(albums))
 
-            for a in albums["albums"]:
-                if a["title"] == album_name:
-                    return a["id"]
+# One album index per session, so albums are listed once per process.
+_album_indexes = weakref.WeakKeyDictionary()
+_album_indexes_lock = threading.Lock()
+_album_cache_file = None
+_album_cache_ttl = 0
 
-            if 'nextPageToken' in albums:
-                params["pageToken"] = albums["nextPageToken"]
-            else:
-                return
 
-        elif "error" in albums:
-            error = albums["error"]
-            if "code" in error and "message" in error and "status" in error:
-                logging.debug("Server response: {}".format(albums))
-                print("error: {}; {}; {}".format(error["code"], error["status"], error["message"]))
-            else:
-                logging.error("Server response: {}".format(albums))
-                
-            return None
+# Save album listings to cache_file and reuse them for ttl seconds.
+def configureAlbumCache(cache_file, ttl):
+    global _album_cache_file, _album_cache_ttl
+    _album_cache_file = cache_file
+    _album_cache_ttl = ttl
 
-        else:
-            return
+
+def getAlbumIndex(session):
+    with _album_indexes_lock:
+        if session not in _album_indexes:
+            _album_indexes[session] = AlbumIndex(_album_cache_file, _album_cache_ttl)
+        return _album_indexes[session]
+
+
+def getAlbumId(session, album_name, app_created_only=False):
+    return getAlbumIndex(session).find(session, album_name, app_created_only)
 
 
 def create_or_retrieve_album(session, album_title):
 
+    album_index = getAlbumIndex(session)
+
     # Find albums created by this app to see if one matches album_title
-    for a in getAlbums(session, True):
-        if a["title"].lower() == album_title.lower():
-            album_id = a["id"]
+    with album_index.lock:
+        album_id = album_index.find(session, album_title, app_created_only=True, ignore_case=True)
+        if album_id:
             logging.info("Uploading into EXISTING photo album -- \'{0}\'".format(album_title))
             return album_id
 
-    # No matches, create new album
-    create_album_body = json.dumps({"album":{"title": album_title}})
-    #print(create_album_body)
-    resp = session.post('https://photoslibrary.googleapis.com/v1/albums', create_album_body).json()
+        # No matches, create new album
+        create_album_body = json.dumps({"album":{"title": album_title}})
+        #print(create_album_body)
+        # Album may have been created by a request that failed, albums are
+        # listed again before it is sent once more. All retries are done
+        # here, so the request is sent at most MAX_RETRIES + 1 times.
+        attempt = 0
+        while True:
+            resp = None
+            try:
+                resp = api_request(session, 'POST', API_URL + '/albums', max_retries=0, idempotent=False, data=create_album_body)
+                if resp.status_code not in RETRY_STATUS_CODES or attempt >= MAX_RETRIES:
+                    break
+                reason = "{} {}".format(resp.status_code, resp.reason)
+            except OSError as err:
+                if attempt >= MAX_RETRIES:
+                    logging.error("Could not find or create photo album \'{0}\' -- {1}".format(album_title, err))
+                    return None
+                reason = err
+
+            delay = retry_delay(attempt, resp)
+            logging.warning("Retrying album create in {:.1f}s -- {}".format(delay, reason))
+            time.sleep(delay)
+            attempt += 1
+
+            album_index.refresh(session, app_created_only=True)
+            album_id = album_index.find(session, album_title, app_created_only=True, ignore_case=True)
+            if album_id:
+                logging.info("Uploading into EXISTING photo album -- \'{0}\'".format(album_title))
+                return album_id
 
-    logging.debug("Server response: {}".format(resp))
+        try:
+            resp = resp.json()
+        except ValueError as err:
+            logging.error("Could not find or create photo album \'{0}\' -- {1} {2}; {3}".format(album_title, resp.status_code, resp.reason, err))
+            return None
+
+        logging.debug("Server response: {}".format(resp))
 
-    if "id" in resp:
-        logging.info("Uploading into NEW photo album -- \'{0}\'".format(album_title))
-        return resp['id']
-    elif "error" in resp:
+        if "id" in resp:
+            logging.info("Uploading into NEW photo album -- \'{0}\'".format(album_title))
+            album_index.add(album_title, resp['id'])
+            return resp['id']
+
+    if "error" in resp:
         error = resp["error"]
         if "code" in error and "message" in error and "status" in error:
-            logging.debug("Could not find or create photo album '\{0}\'. Server Response: {1}".format(album_title, resp))
-            print("error: {}; {}; {}".format(error["code"], error["status"], error["message"]))
+            logging.debug("Could not find or create photo album \'{0}\'. Server Response: {1}".format(album_title, resp))
+            logging.error("Could not find or create photo album \'{0}\' -- {1}; {2}; {3}".format(album_title, error["code"], error["status"], error["message"]))
         else:
-            logging.error("Could not find or create photo album '\{0}\'. Server Response: {1}".format(album_title, resp))
+            logging.error("Could not find or create photo album \'{0}\'. Server Response: {1}".format(album_title, resp))
         return None
     else:
-        logging.error("Could not find or create photo album '\{0}\'. Server Response: {1}".format(album_title, resp))
+        logging.error("Could not find or create photo album \'{0}\'. Server Response: {1}".format(album_title, resp))
+        return None
+
+
+# Local record of uploaded files, kept in a SQLite database so that reruns
+# decide which files to skip without listing album content. Files are keyed
+# by path, size, mtime and album they were uploaded to. Media item of each
+# uploaded content hash is kept too, so same content found in another folder
+# is added to album without uploading it again. Upload URLs of unfinished
+# resumable uploads are kept here too, so upload of a large file can continue
+# from where it stopped if process is killed.
+class UploadState:
+
+    def __init__(self, file_name):
+        self.lock = threading.Lock()
+        # Worker processes of '--workers' share one state file.
+        self.db = sqlite3.connect(file_name, timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        new_media_index = self.db.execute("SELECT name FROM sqlite_master WHERE name = 'media_items'").fetchone() is None
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                album_id TEXT NOT NULL,
+                sha256 TEXT,
+                upload_token TEXT,
+                uploaded REAL,
+                media_item_id TEXT,
+                PRIMARY KEY (path, size, mtime_ns, album_id)
+            );
+            CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256, album_id);
+            CREATE TABLE IF NOT EXISTS media_items (
+                sha256 TEXT PRIMARY KEY,
+                media_item_id TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS upload_sessions (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                granularity INTEGER NOT NULL
+            );
+        ''')
+        # State files written before the index existed already know hashes of uploaded files.
+        if new_media_index:
+            self.db.execute("INSERT OR IGNORE INTO media_items SELECT sha256, media_item_id FROM files "
+                            "WHERE sha256 IS NOT NULL AND media_item_id IS NOT NULL")
+        self.db.commit()
+
+    @staticmethod
+    def _key(photo_file_name, stat, album_id):
+        return (os.path.abspath(os.fsdecode(photo_file_name)), stat.st_size, stat.st_mtime_ns, album_id or "")
+
+    def lookup(self, photo_file_name, stat, album_id):
+        with self.lock:
+            return self.db.execute("SELECT * FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND album_id = ?",
+                                   self._key(photo_file_name, stat, album_id)).fetchone()
+
+    def find_sha256(self, sha256, album_id):
+        with self.lock:
+            return self.db.execute("SELECT * FROM files WHERE sha256 = ? AND album_id = ? AND media_item_id IS NOT NULL",
+                                   (sha256, album_id or "")).fetchone()
+
+    # Id of media item in library with this content, or None.
+    def find_media_item(self, sha256):
+        with self.lock:
+            row = self.db.execute("SELECT media_item_id FROM media_items WHERE sha256 = ?", (sha256,)).fetchone()
+        return row["media_item_id"] if row else None
+
+    def forget_media_item(self, media_item_id):
+        with self.lock:
+            self.db.execute("DELETE FROM media_items WHERE media_item_id = ?", (media_item_id,))
+            self.db.commit()
+
+    def record_upload(self, photo_file_name, stat, album_id, upload_token, sha256=None):
+        with self.lock:
+            self.db.execute("INSERT INTO files (path, size, mtime_ns, album_id, sha256, upload_token, uploaded) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                            "ON CONFLICT (path, size, mtime_ns, album_id) DO UPDATE SET sha256 = excluded.sha256, upload_token = excluded.upload_token, uploaded = excluded.uploaded",
+                            self._key(photo_file_name, stat, album_id) + (sha256, upload_token, time.time()))
+            self.db.commit()
+
+    def record_media_item(self, photo_file_name, stat, album_id, media_item_id, sha256=None):
+        with self.lock:
+            self.db.execute("INSERT INTO files (path, size, mtime_ns, album_id, sha256, media_item_id) VALUES (?, ?, ?, ?, ?, ?) "
+                            "ON CONFLICT (path, size, mtime_ns, album_id) DO UPDATE SET sha256 = coalesce(excluded.sha256, sha256), media_item_id = excluded.media_item_id",
+                            self._key(photo_file_name, stat, album_id) + (sha256, media_item_id))
+            if sha256:
+                self.db.execute("INSERT OR REPLACE INTO media_items (sha256, media_item_id) VALUES (?, ?)", (sha256, media_item_id))
+            self.db.commit()
+
+    def get_upload_session(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT url, granularity FROM upload_sessions WHERE key = ?", (key,)).fetchone()
+        return {"url": row["url"], "granularity": row["granularity"]} if row else None
+
+    def set_upload_session(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO upload_sessions (key, url, granularity) VALUES (?, ?, ?)",
+                            (key, value["url"], value["granularity"]))
+            self.db.commit()
+
+    def remove_upload_session(self, key):
+        with self.lock:
+            self.db.execute("DELETE FROM upload_sessions WHERE key = ?", (key,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Durable queue of files to upload, shared by worker processes of '--workers'
+# through a SQLite database. A worker claims a batch of files of one album
+# under a lease that expires unless the worker extends it, so files claimed
+# by a worker that died are claimed again by another one. Albums created by
+# workers are recorded per token file, so workers uploading with the same
+# account don't create the same album twice.
+class WorkQueue:
+
+    def __init__(self, file_name):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file_name, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS work (
+                id INTEGER PRIMARY KEY,
+                album TEXT NOT NULL,
+                path TEXT NOT NULL UNIQUE,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                owner TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS work_state ON work (state, album);
+            CREATE TABLE IF NOT EXISTS albums (
+                account TEXT NOT NULL,
+                title TEXT NOT NULL,
+                album_id TEXT NOT NULL,
+                PRIMARY KEY (account, title)
+            );
+        ''')
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    # Queue files of album, given as (path, stat) pairs. Files already done
+    # are queued again only if they changed since.
+    def add(self, album, files):
+        with self.transaction() as db:
+            db.executemany("INSERT INTO work (album, path, size, mtime_ns) VALUES (?, ?, ?, ?) "
+                           "ON CONFLICT (path) DO UPDATE SET album = excluded.album, size = excluded.size, mtime_ns = excluded.mtime_ns, "
+                           "state = 'queued', owner = NULL, attempts = 0 "
+                           "WHERE size != excluded.size OR mtime_ns != excluded.mtime_ns OR album != excluded.album OR state = 'failed'",
+                           ((album, os.path.abspath(path), stat.st_size, stat.st_mtime_ns) for path, stat in files))
+
+    # Claim up to count files of one album, returns (album, [(id, path)]) or
+    # None if no file is waiting.
+    def claim(self, owner, count=WORK_BATCH_SIZE, lease=WORK_LEASE):
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("UPDATE work SET state = 'failed' WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                       (now, MAX_WORK_ATTEMPTS))
+            available = "(state = 'queued' OR (state = 'leased' AND lease_expires < ?))"
+            row = db.execute("SELECT album FROM work WHERE " + available + " ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            rows = db.execute("SELECT id, path FROM work WHERE album = ? AND " + available + " ORDER BY id LIMIT ?",
+                              (row["album"], now, count)).fetchall()
+            db.executemany("UPDATE work SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                           ((owner, now + lease, r["id"]) for r in rows))
+        return row["album"], [(r["id"], r["path"]) for r in rows]
+
+    def renew(self, owner, lease=WORK_LEASE):
+        with self.transaction() as db:
+            db.execute("UPDATE work SET lease_expires = ? WHERE state = 'leased' AND owner = ?", (time.time() + lease, owner))
+
+    # Mark claimed files done, or give them back to queue to be tried again.
+    def finish(self, owner, done_ids, failed_ids):
+        with self.transaction() as db:
+            db.executemany("UPDATE work SET state = 'done', owner = NULL WHERE id = ? AND owner = ?",
+                           ((i, owner) for i in done_ids))
+            db.executemany("UPDATE work SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, owner = NULL "
+                           "WHERE id = ? AND owner = ?", ((MAX_WORK_ATTEMPTS, i, owner) for i in failed_ids))
+
+    # Returns number of files in each state.
+    def counts(self):
+        with self.lock:
+            return {r["state"]: r["count"] for r in self.db.execute("SELECT state, count(*) AS count FROM work GROUP BY state")}
+
+    def sizes(self):
+        with self.lock:
+            return {r["state"]: r["size"] for r in self.db.execute("SELECT state, total(size) AS size FROM work GROUP BY state")}
+
+    def get_album(self, account, title):
+        with self.lock:
+            row = self.db.execute("SELECT album_id FROM albums WHERE account = ? AND title = ?", (account, title)).fetchone()
+        return row["album_id"] if row else None
+
+    # Record album of account, unless another worker recorded one first.
+    # Returns id of the album recorded.
+    def add_album(self, account, title, album_id):
+        with self.transaction() as db:
+            db.execute("INSERT OR IGNORE INTO albums (account, title, album_id) VALUES (?, ?, ?)", (account, title, album_id))
+            return db.execute("SELECT album_id FROM albums WHERE account = ? AND title = ?", (account, title)).fetchone()["album_id"]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Local copy of albums and their media items, so albums can be listed and
+# searched for files without API calls. Albums are kept in the order server
+# lists them, media items in album order. Items keep their JSON as listed,
+# without 'baseUrl' which expires within hours; API has no size in bytes of
+# items, their width and height are kept instead.
+class Catalog:
+
+    def __init__(self, file_name):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file_name, timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS albums (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                listed_count TEXT,
+                json TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS albums_title ON albums (title);
+            CREATE TABLE IF NOT EXISTS media_items (
+                id TEXT PRIMARY KEY,
+                filename TEXT,
+                description TEXT,
+                creation_time TEXT,
+                width INTEGER,
+                height INTEGER,
+                json TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS album_items (
+                album_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                media_item_id TEXT NOT NULL,
+                PRIMARY KEY (album_id, position)
+            );
+            CREATE INDEX IF NOT EXISTS album_items_media_item ON album_items (media_item_id);
+        ''')
+        self.db.commit()
+
+    def albums(self):
+        with self.lock:
+            return [json.loads(r["json"]) for r in self.db.execute("SELECT json FROM albums ORDER BY position")]
+
+    def find_album(self, title):
+        with self.lock:
+            row = self.db.execute("SELECT id FROM albums WHERE title = ? ORDER BY position LIMIT 1", (title,)).fetchone()
+        return row["id"] if row else None
+
+    def album_items(self, album_id):
+        with self.lock:
+            return [json.loads(r["json"]) for r in self.db.execute(
+                "SELECT m.json FROM album_items a JOIN media_items m ON m.id = a.media_item_id "
+                "WHERE a.album_id = ? ORDER BY a.position", (album_id,))]
+
+    # Returns {file name: media item id} of files in album.
+    def album_files(self, album_id):
+        with self.lock:
+            return {r["filename"]: r["id"] for r in self.db.execute(
+                "SELECT m.id, m.filename FROM album_items a JOIN media_items m ON m.id = a.media_item_id "
+                "WHERE a.album_id = ? AND m.filename IS NOT NULL", (album_id,))}
+
+    def counts(self):
+        with self.lock:
+            return (self.db.execute("SELECT count(*) FROM albums").fetchone()[0],
+                    self.db.execute("SELECT count(*) FROM media_items").fetchone()[0])
+
+    # Update catalog from server. Albums are listed, and content is listed
+    # again only of new albums and of albums whose mediaItemsCount changed,
+    # 'jobs' albums at a time. Albums gone from server are removed. Returns
+    # (albums listed again, albums unchanged, albums that could not be
+    # listed); raises RefreshError, OSError or ValueError if albums can't be
+    # listed.
+    def refresh(self, session, jobs=1):
+        with metrics.timer("album_list"):
+            albums = [a for page in getAlbumPages(session) for a in page if "id" in a]
+
+        with self.lock, self.db:
+            listed = {r["id"]: r["listed_count"] for r in self.db.execute("SELECT id, listed_count FROM albums")}
+            ids = set(a["id"] for a in albums)
+            for album_id in set(listed) - ids:
+                self.db.execute("DELETE FROM album_items WHERE album_id = ?", (album_id,))
+                self.db.execute("DELETE FROM albums WHERE id = ?", (album_id,))
+            # Count of album is updated once its content is stored, so an
+            # interrupted refresh lists it again next time.
+            self.db.executemany("INSERT INTO albums (id, title, position, json) VALUES (?, ?, ?, ?) "
+                                "ON CONFLICT (id) DO UPDATE SET title = excluded.title, position = excluded.position, json = excluded.json",
+                                [(a["id"], a.get("title", ""), i, json.dumps(a)) for i, a in enumerate(albums)])
+
+        changed = [a for a in albums if listed.get(a["id"]) != a.get("mediaItemsCount", "0")]
+
+        def list_album(album):
+            return [item for page in getAlbumContentPages(session, album["id"]) for item in page]
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(list_album, a): a for a in changed}
+            for future in as_completed(futures):
+                album = futures[future]
+                try:
+                    items = future.result()
+                except (OSError, ValueError) as err:
+                    logging.error("Could not list album \'{0}\' -- {1}".format(album.get("title"), err))
+                    failed += 1
+                    continue
+                self.store_album_items(album, items)
+
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM media_items WHERE id NOT IN (SELECT media_item_id FROM album_items)")
+
+        return len(changed) - failed, len(albums) - len(changed), failed
+
+    def store_album_items(self, album, items):
+        rows = []
+        for item in items:
+            metadata = item.get("mediaMetadata", {})
+            item = {k: v for k, v in item.items() if k != "baseUrl"}
+            rows.append((item["id"], item.get("filename"), item.get("description"), metadata.get("creationTime"),
+                         int(metadata.get("width", 0)) or None, int(metadata.get("height", 0)) or None, json.dumps(item)))
+
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO media_items (id, filename, description, creation_time, width, height, json) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("DELETE FROM album_items WHERE album_id = ?", (album["id"],))
+            self.db.executemany("INSERT INTO album_items (album_id, position, media_item_id) VALUES (?, ?, ?)",
+                                [(album["id"], i, row[0]) for i, row in enumerate(rows)])
+            self.db.execute("UPDATE albums SET listed_count = ? WHERE id = ?", (album.get("mediaItemsCount", "0"), album["id"]))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# returns hex sha256 digest of file content, or None if file can't be read
+def getFileHash(file_path):
+    digest = hashlib.sha256()
+    try:
+        with open(file_path, mode='rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    except OSError as err:
+        logging.error("Could not read file \'{0}\' -- {1}".format(file_path, err))
         return None
 
+    return digest.hexdigest()
 
-def upload_photos(session, photo_file_list, album_name):
 
-    album_id = create_or_retrieve_album(session, album_name) if album_name else None
+# Body of an upload request, read by connection a block at a time. Every block
+# waits for bandwidth limit and is counted by progress.
+class UploadBody:
 
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
 
-    # interrupt upload if an upload was requested but could not be created
-    if album_name and not album_id:
-        return False
+    def __len__(self):
+        return len(self.data)
 
-    # Get album content
-    existing_files_list = list(getAlbumContent(session,album_id)) 
+    def seek(self, offset):
+        self.offset = offset
 
-    session.headers["Content-type"] = "application/octet-stream"
-    session.headers["X-Goog-Upload-Protocol"] = "raw"
+    def read(self, size=-1):
+        end = len(self.data) if size is None or size < 0 else self.offset + size
+        block = self.data[self.offset:end]
+        self.offset += len(block)
+        if _bandwidth:
+            _bandwidth.acquire(len(block))
+        progress.sent(len(block))
+        return block
 
-    for photo_file_name_unsafe in photo_file_list:
 
-            photo_file_name = photo_file_name_unsafe.encode(encoding = 'UTF-8', errors = 'strict')
+# Read a file and send its bytes to upload endpoint, returns upload token or None.
+# Runs on a worker thread, so per-file headers are passed with the request and
+# never set on the shared session. Files larger than one chunk are streamed
+# with resumable upload protocol and never read whole into memory.
+def upload_file(session, photo_file_name, chunk_size=DEFAULT_CHUNK_SIZE, state=None):
+    try:
+        stat = os.stat(photo_file_name)
+    except OSError as err:
+        logging.error("Could not read file \'{0}\' -- {1}".format(photo_file_name, err))
+        return None
+
+    if stat.st_size > chunk_size:
+        return upload_file_resumable(session, photo_file_name, stat, chunk_size, state)
+
+    try:
+        with metrics.timer("read"), open(photo_file_name, mode='rb') as photo_file:
+            photo_bytes = photo_file.read()
+    except OSError as err:
+        logging.error("Could not read file \'{0}\' -- {1}".format(photo_file_name, err))
+        return None
+
+    headers = {
+        "Content-type": "application/octet-stream",
+        "X-Goog-Upload-Protocol": "raw",
+        "X-Goog-Upload-File-Name": os.path.basename(photo_file_name)
+    }
+
+    logging.info("Uploading photo -- \'{}\'".format(photo_file_name))
+
+    # Whole upload must finish within session's upload timeout, if it has one.
+    upload_timeout = getattr(session, "upload_timeout", None)
+    timeout_args = {"max_allowed_time": upload_timeout} if upload_timeout else {}
+
+    try:
+        with metrics.timer("upload"):
+            upload_token = api_request(session, 'POST', API_URL + '/uploads', data=UploadBody(photo_bytes), headers=headers, **timeout_args)
+    except OSError as err:
+        logging.error("Could not upload \'{0}\' -- {1}".format(os.path.basename(photo_file_name), err))
+        return None
+
+    if (upload_token.status_code == 200) and (upload_token.content):
+        metrics.count("bytes_sent", len(photo_bytes))
+        return upload_token.content.decode()
+
+    logging.error("Could not upload \'{0}\'. Server Response - {1}".format(os.path.basename(photo_file_name), upload_token))
+    return None
+
+
+# Start a resumable upload session, returns (upload_url, chunk_granularity) or None.
+def start_resumable_upload(session, photo_file_name, file_size):
+    headers = {
+        "Content-Length": "0",
+        "X-Goog-Upload-Command": "start",
+        "X-Goog-Upload-Protocol": "resumable",
+        "X-Goog-Upload-Raw-Size": str(file_size),
+        "X-Goog-Upload-File-Name": os.path.basename(photo_file_name)
+    }
+
+    content_type = mimetypes.guess_type(os.fsdecode(photo_file_name))[0]
+    if content_type:
+        headers["X-Goog-Upload-Content-Type"] = content_type
+
+    try:
+        resp = api_request(session, 'POST', API_URL + '/uploads', headers=headers)
+    except OSError as err:
+        logging.error("Could not start upload of \'{0}\' -- {1}".format(os.path.basename(photo_file_name), err))
+        return None
+
+    if resp.status_code != 200 or "X-Goog-Upload-URL" not in resp.headers:
+        logging.error("Could not start upload of \'{0}\'. Server Response - {1}".format(os.path.basename(photo_file_name), resp))
+        return None
+
+    return resp.headers["X-Goog-Upload-URL"], int(resp.headers.get("X-Goog-Upload-Chunk-Granularity", 1))
+
+
+# Ask server how many bytes of a resumable upload it has received. Returns None
+# if upload session is not active any more and upload has to start from zero.
+def query_resumable_upload(session, upload_url):
+    try:
+        resp = api_request(session, 'POST', upload_url, headers={"Content-Length": "0", "X-Goog-Upload-Command": "query"})
+    except OSError as err:
+        logging.debug("Could not query upload status -- {0}".format(err))
+        return None
+
+    if resp.status_code != 200 or resp.headers.get("X-Goog-Upload-Status") != "active":
+        logging.debug("Upload session not active. Server Response - {0} {1}".format(resp, resp.headers))
+        return None
+
+    return int(resp.headers.get("X-Goog-Upload-Size-Received", 0))
+
+
+def upload_file_resumable(session, photo_file_name, stat, chunk_size, state):
+    file_size = stat.st_size
+    key = "{}|{}|{}".format(os.path.abspath(os.fsdecode(photo_file_name)), file_size, stat.st_mtime_ns)
+
+    offset = None
+    saved = state.get_upload_session(key) if state else None
+    if saved:
+        upload_url, granularity = saved["url"], saved["granularity"]
+        offset = query_resumable_upload(session, upload_url)
+        if offset is not None:
+            logging.info("Resuming upload at byte {0} -- \'{1}\'".format(offset, photo_file_name))
+
+    if offset is None:
+        started = start_resumable_upload(session, photo_file_name, file_size)
+        if not started:
+            return None
+        upload_url, granularity = started
+        offset = 0
+        if state:
+            state.set_upload_session(key, {"url": upload_url, "granularity": granularity})
+
+    # Every chunk except the last one must be a multiple of granularity.
+    chunk_size = max(granularity, chunk_size - chunk_size % granularity)
+
+    logging.info("Uploading photo -- \'{}\'".format(photo_file_name))
+
+    # Whole upload must finish within session's upload timeout, if it has one.
+    upload_timeout = getattr(session, "upload_timeout", None)
+    deadline = time.monotonic() + upload_timeout if upload_timeout else None
+
+    failures = 0
+    try:
+        with open(photo_file_name, mode='rb') as photo_file:
+            while True:
+                if deadline and time.monotonic() > deadline:
+                    logging.error("Could not upload \'{0}\' -- Timed out after {1} seconds".format(os.path.basename(photo_file_name), upload_timeout))
+                    return None
+
+                with metrics.timer("read"):
+                    photo_file.seek(offset)
+                    chunk = photo_file.read(chunk_size)
+                last_chunk = offset + len(chunk) >= file_size
+                headers = {
+                    "X-Goog-Upload-Command": "upload, finalize" if last_chunk else "upload",
+                    "X-Goog-Upload-Offset": str(offset)
+                }
+
+                try:
+                    with metrics.timer("upload"):
+                        resp = api_request(session, 'POST', upload_url, max_retries=0, data=UploadBody(chunk), headers=headers)
+                except OSError as err:
+                    resp = err
+
+                if not isinstance(resp, OSError) and resp.status_code == 200:
+                    metrics.count("bytes_sent", len(chunk))
+                    if last_chunk:
+                        if state:
+                            state.remove_upload_session(key)
+                        if resp.content:
+                            return resp.content.decode()
+                        logging.error("Could not upload \'{0}\'. Server Response - {1}".format(os.path.basename(photo_file_name), resp))
+                        return None
+                    offset += len(chunk)
+                    failures = 0
+                    continue
+
+                # Chunk failed, continue from last byte server has acknowledged.
+                failures += 1
+                if failures > MAX_CHUNK_RETRIES:
+                    logging.error("Could not upload \'{0}\'. Server Response - {1}".format(os.path.basename(photo_file_name), resp))
+                    return None
+
+                time.sleep(retry_delay(failures - 1, resp))
+                acked = query_resumable_upload(session, upload_url)
+                if acked is None:
+                    if state:
+                        state.remove_upload_session(key)
+                    logging.error("Could not upload \'{0}\', upload session lost. Server Response - {1}".format(os.path.basename(photo_file_name), resp))
+                    return None
+
+                logging.warning("Retrying upload at byte {0} -- \'{1}\'".format(acked, photo_file_name))
+                offset = acked
+
+    except OSError as err:
+        logging.error("Could not read file \'{0}\' -- {1}".format(photo_file_name, err))
+        return None
+
+
+# Downscale image to at most max_pixels and save it as JPEG of given quality,
+# keeping EXIF and color profile. Runs in a worker process of ImageOptimizer,
+# returns size of written file.
+def optimizeImage(source, target, max_pixels, quality):
+    from PIL import Image
+
+    with Image.open(source) as image:
+        info = image.info
+        width, height = image.size
+        scale = min(1.0, (max_pixels / (width * height)) ** 0.5)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+        # Let JPEG decoder skip detail that would be scaled away anyway.
+        image.draft(image.mode, size)
+        if image.size != size:
+            image = image.resize(size, Image.LANCZOS)
+
+        options = {"quality": quality, "optimize": True}
+        for key in ("exif", "icc_profile"):
+            if info.get(key):
+                options[key] = info[key]
+        image.save(target, "JPEG", **options)
+
+    return os.path.getsize(target)
+
+
+# Recompresses photos on a pool of worker processes before they are uploaded,
+# see optimizeImage. Work on a file starts as soon as it is queued for upload,
+# so at most as many optimized copies exist at a time as files are queued by
+# syncAlbums. Each copy is written into its own temporary folder under the
+# name of original file, so it is uploaded under the same name.
+class ImageOptimizer:
+
+    def __init__(self, max_megapixels=DEFAULT_OPTIMIZE_MEGAPIXELS, quality=DEFAULT_OPTIMIZE_QUALITY, processes=None):
+        self.max_pixels = int(max_megapixels * 1000000)
+        self.quality = quality
+        self.lock = threading.Lock()
+
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        self.folders = set()
+        # Fork is not safe in a process with running upload threads.
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+    # Start optimizing a file, returns (optimized_file_name, future) or None
+    # if file is not a photo that can be optimized.
+    def submit(self, photo_file_name):
+        photo_file_name = os.fsdecode(photo_file_name)
+        if os.path.splitext(photo_file_name)[1].lower() not in OPTIMIZE_EXTENSIONS:
+            return None
+
+        folder = tempfile.mkdtemp(prefix="gphoto_")
+        with self.lock:
+            self.folders.add(folder)
+        target = os.path.join(folder, os.path.basename(photo_file_name))
+        return target, self.executor.submit(optimizeImage, photo_file_name, target, self.max_pixels, self.quality)
+
+    # Wait for optimized copy of a file, returns its name, or None if it could
+    # not be made or is not smaller than original file.
+    def result(self, photo_file_name, optimized):
+        target, future = optimized
+        try:
+            original_size = os.stat(photo_file_name).st_size
+            with metrics.timer("optimize"):
+                size = future.result()
+        except Exception as err:
+            logging.warning("Could not optimize \'{0}\', uploading original -- {1}".format(photo_file_name, err))
+            return None
+
+        if size >= original_size:
+            return None
+
+        logging.info("Optimized \'{}\' from {} to {} bytes".format(photo_file_name, original_size, size))
+        metrics.count("files_optimized")
+        metrics.count("bytes_saved", original_size - size)
+        return target
+
+    def cleanup(self, optimized):
+        optimized[1].cancel()
+        folder = os.path.dirname(optimized[0])
+        shutil.rmtree(folder, ignore_errors=True)
+        with self.lock:
+            self.folders.discard(folder)
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        with self.lock:
+            for folder in self.folders:
+                shutil.rmtree(folder, ignore_errors=True)
+            self.folders.clear()
+
+
+# Count file of an upload item as done, with result 'uploaded', 'reused',
+# 'skipped' or 'failed', and pass it to 'on_result' callback of the item, if it
+# has one, with media item that is the file in album, or None.
+def report_file_result(item, result, media_item=None):
+    metrics.count("files", result=result)
+    if item.get("on_result"):
+        item["on_result"](os.fsdecode(item["file"]), result, media_item)
+
+
+# Create media items for a batch of uploaded files and add them to album.
+# Batch is a list of at most MAX_BATCH_CREATE items, each a dict with 'file',
+# 'upload_token' and 'description'. Returns list of media items, one per file
+# in the batch, with None for files that could not be added.
+def create_media_items(session, album_id, album_name, batch):
+
+    new_items = [{"description": item["description"], "simpleMediaItem": {"uploadToken": item["upload_token"]}} for item in batch]
+    create_body = json.dumps({"albumId": album_id, "newMediaItems": new_items}, indent=4)
+
+    # add items to album
+    try:
+        with metrics.timer("batch_create"):
+            resp = api_request(session, 'POST', API_URL + '/mediaItems:batchCreate', idempotent=False, data=create_body).json()
+    except (OSError, ValueError) as err:
+        resp = {"error": str(err)}
+
+    logging.debug("Server response: {}".format(resp))
+
+    if "newMediaItemResults" not in resp:
+        for item in batch:
+            logging.error("Could not add \'{0}\' to library. Server Response -- {1}".format(os.path.basename(item["file"]), resp))
+            report_file_result(item, "failed")
+        return [None] * len(batch)
+
+    # Results carry upload token of the item they belong to, fall back to
+    # request order if server left it out.
+    results = resp["newMediaItemResults"]
+    by_token = {r["uploadToken"]: r for r in results if "uploadToken" in r}
+
+    media_items = []
+    for i, item in enumerate(batch):
+        photo_file_name = item["file"]
+        result = by_token.get(item["upload_token"], results[i] if i < len(results) else None)
+        status = result.get("status", {}) if result else {"message": "Missing from server response"}
+
+        if (status.get("code") and (status.get("code") > 0)) or not result or "mediaItem" not in result:
+            logging.error("Could not add \'{0}\' to library -- {1}".format(os.path.basename(photo_file_name), status.get("message")))
+            report_file_result(item, "failed")
+            media_items.append(None)
+        else:
+            report_file_result(item, "uploaded", result["mediaItem"])
+            logging.info("Added \'{}\' to library and album \'{}\' ".format(os.path.basename(photo_file_name), album_name))
+            # Items with a callback get media item from it, nothing is printed for them.
+            if not item.get("on_result"):
+                productUrl = result["mediaItem"]["productUrl"]
+                filename = result["mediaItem"]["filename"]
+                print("{} URL: {}".format(filename,productUrl))
+            media_items.append(result["mediaItem"])
+
+    return media_items
+
+
+# Create media items for a batch and record them in local state.
+def commit_batch(session, album_id, album_name, batch, state):
+    media_items = create_media_items(session, album_id, album_name, batch)
+
+    if state:
+        for item, media_item in zip(batch, media_items):
+            if media_item:
+                state.record_media_item(item["file"], item["stat"], album_id, media_item["id"], item.get("sha256"))
+
+
+# Add media items already in library to album, for files whose content was
+# uploaded before from another folder. Batch is a list of at most
+# MAX_BATCH_CREATE items, each a dict with 'file', 'stat', 'sha256' and
+# 'media_item_id'. One media item the server rejects, e.g. one deleted since,
+# fails the whole batch, so a rejected batch is split in halves that are added
+# on their own. Media items rejected on their own are forgotten in local state
+# so that these files are uploaded on next run.
+def add_media_items(session, album_id, album_name, batch, state):
+
+    add_body = json.dumps({"mediaItemIds": [item["media_item_id"] for item in batch]})
+
+    rejected = False
+    try:
+        with metrics.timer("batch_add"):
+            resp = api_request(session, 'POST', API_URL + '/albums/{}:batchAddMediaItems'.format(album_id), data=add_body)
+        error = None if resp.status_code == 200 else resp.text
+        rejected = resp.status_code == 400
+    except OSError as err:
+        error = str(err)
+
+    if rejected and len(batch) > 1:
+        middle = len(batch) // 2
+        add_media_items(session, album_id, album_name, batch[:middle], state)
+        add_media_items(session, album_id, album_name, batch[middle:], state)
+        return
+
+    if error is not None:
+        for item in batch:
+            logging.error("Could not add \'{0}\' to album from library. Server Response -- {1}".format(os.path.basename(item["file"]), error))
+            if state and rejected:
+                state.forget_media_item(item["media_item_id"])
+            report_file_result(item, "failed")
+        return
+
+    for item in batch:
+        logging.info("Added \'{}\' to album \'{}\' from library".format(os.path.basename(item["file"]), album_name))
+        report_file_result(item, "reused", {"id": item["media_item_id"]})
+        metrics.count("bytes_reused", item["stat"].st_size)
+        if state:
+            state.record_media_item(item["file"], item["stat"], album_id, item["media_item_id"], item["sha256"])
+
+
+# Description written into new media item, album name and file's creation time.
+def getItemDescription(album_name, photo_file_name, stat=None, creation_time=None):
+    try:
+        creation_date = getFileCreationDate(photo_file_name, stat, creation_time)
+    except ValueError as exp:
+        logging.warning("Could not get creation time of \'{0}\' -- {1}".format(os.fsdecode(photo_file_name), exp))
+        return album_name or ""
+
+    return (album_name or "") + ' @' + creation_date
+
+
+# Runs on a worker thread: hash file if asked to and upload it, unless file
+# with same content is already in album according to local state. Content
+# already in library is not uploaded, its media item is added to album.
+# Optimized copy of the file is uploaded instead of it, if one was started.
+# Description is made here too, as it reads file header.
+def upload_worker(session, item, album_id, album_name, chunk_size, state, hash_files, optimizer=None):
+    optimized = item.pop("optimized", None)
+    try:
+        item["description"] = getItemDescription(album_name, item["file"], item["stat"], item.get("creation_time"))
+        return upload_item(session, item, album_id, chunk_size, state, hash_files, optimizer, optimized)
+    finally:
+        progress.file_done(item["stat"].st_size)
+        if optimized:
+            optimizer.cleanup(optimized)
+
+
+def upload_item(session, item, album_id, chunk_size, state, hash_files, optimizer, optimized):
+    if hash_files:
+        with metrics.timer("hash"):
+            item["sha256"] = getFileHash(item["file"])
+        record = state.find_sha256(item["sha256"], album_id) if item["sha256"] and state else None
+        if record:
+            logging.info("Skipping photo(same content already uploaded to album) -- \'{}\'".format(item["file"]))
+            report_file_result(item, "skipped", {"id": record["media_item_id"]})
+            state.record_media_item(item["file"], item["stat"], album_id, record["media_item_id"], item["sha256"])
+            item["skipped"] = True
+            return item
+
+        media_item_id = state.find_media_item(item["sha256"]) if item["sha256"] and state and album_id else None
+        if media_item_id:
+            logging.info("Reusing photo(same content already in library) -- \'{}\'".format(item["file"]))
+            item["media_item_id"] = media_item_id
+            return item
+
+    upload_file_name = optimized and optimizer.result(item["file"], optimized)
+    item["upload_token"] = upload_file(session, upload_file_name or item["file"], chunk_size, state)
+    if item["upload_token"] and state:
+        state.record_upload(item["file"], item["stat"], album_id, item["upload_token"], item.get("sha256"))
+    return item
+
+
+# Wait for upload of a file to finish and add it to batch, or to add_batch if
+# its content is already in library. Batches are committed and emptied once
+# they are full. A file whose upload raised is failed, other files go on.
+def commit_finished_upload(session, album_id, album_name, batch, add_batch, state, future, item):
+    try:
+        future.result()
+    except Exception as err:
+        logging.error("Could not upload \'{0}\' -- {1!r}".format(os.fsdecode(item["file"]), err))
+        report_file_result(item, "failed")
+        return
+
+    if item.get("media_item_id"):
+        add_batch.append(item)
+    elif item.get("upload_token"):
+        if "description" not in item:
+            item["description"] = getItemDescription(album_name, item["file"], item["stat"], item.get("creation_time"))
+        batch.append(item)
+    elif not item.get("skipped"):
+        report_file_result(item, "failed")
+
+    if len(batch) >= MAX_BATCH_CREATE:
+        commit_batch(session, album_id, album_name, batch, state)
+        batch.clear()
+
+    if len(add_batch) >= MAX_BATCH_CREATE:
+        add_media_items(session, album_id, album_name, add_batch, state)
+        add_batch.clear()
+
+
+# State of one album being uploaded by syncAlbums. Files are sorted by size
+# into two lanes, each uploaded by workers of its own: 'small' files are sent
+# whole, 'large' files, larger than one chunk, are sent in chunks. Up to
+# LANE_LOOKAHEAD files are read ahead of what was submitted, so small files
+# behind a large one are not held up by it. Uploads of each lane are
+# committed in the order their files were given.
+class AlbumUpload:
+
+    def __init__(self, session, album_name, album_id, files, chunk_size, state, reconcile, hash_files, optimizer, catalog=None, on_result=None,
+                 creation_times=None):
+        self.session = session
+        self.album_name = album_name
+        self.album_id = album_id
+        self.files = iter(files)
+        self.creation_times = creation_times or {}
+        self.chunk_size = chunk_size
+        self.state = state
+        self.hash_files = hash_files
+        self.optimizer = optimizer
+        self.on_result = functools.partial(on_result, album_name) if on_result else None
+        self.waiting = {lane: deque() for lane in UPLOAD_LANES}
+        self.pending = {lane: deque() for lane in UPLOAD_LANES}
+        self.bytes_in_flight = 0
+        self.batch = []
+        self.add_batch = []
+        self.exhausted = False
+        self.small_done = False
+
+        # Album content is listed only when reconciling, otherwise local state
+        # decides which files were already uploaded. Catalog answers the same
+        # without listing album on server.
+        self.existing_files = {}
+        if catalog and album_id:
+            self.existing_files = catalog.album_files(album_id)
+        elif reconcile:
+            self.existing_files = {a["filename"]: a["id"] for a in getAlbumContent(session, album_id) if "filename" in a}
+
+    # Read files until one is waiting in lane, or LANE_LOOKAHEAD files are
+    # waiting in both lanes. Files that need no upload are reported here.
+    def read_ahead(self, lane):
+        state = self.state
+
+        while not self.waiting[lane] and sum(len(w) for w in self.waiting.values()) < LANE_LOOKAHEAD:
+            photo_file_name_unsafe = next(self.files, None)
+            if photo_file_name_unsafe is None:
+                self.exhausted = True
+                return
+
+            photo_file_name = str(photo_file_name_unsafe).encode(encoding = 'UTF-8', errors = 'strict')
             # For debugging Unicode: print("PHOTO FILE NAME: {}".format(photo_file_name))
+            item = {"file": photo_file_name, "on_result": self.on_result,
+                    "creation_time": self.creation_times.get(photo_file_name_unsafe)}
+
+            try:
+                stat = item["stat"] = os.stat(photo_file_name)
+            except OSError as err:
+                logging.error("Could not read file \'{0}\' -- {1}".format(photo_file_name, err))
+                report_file_result(item, "failed")
+                progress.file_done(0)
+                continue
 
             #if file with this name already exists in this album
             #don't upload it  
-            if os.path.basename(photo_file_name) in existing_files_list:
+            media_item_id = self.existing_files.get(os.path.basename(os.fsdecode(photo_file_name)))
+            if media_item_id:
                 logging.info("Skipping photo(already exist in album) -- \'{}\'".format(photo_file_name))
+                report_file_result(item, "skipped", {"id": media_item_id})
+                progress.file_done(stat.st_size)
+                if state:
+                    state.record_media_item(photo_file_name, stat, self.album_id, media_item_id)
                 continue
-            try:
-                photo_file = open(photo_file_name, mode='rb')
-                photo_bytes = photo_file.read()
-            except OSError as err:
-                logging.error("Could not read file \'{0}\' -- {1}".format(photo_file_name, err))
+
+            record = state.lookup(photo_file_name, stat, self.album_id) if state else None
+            if record and record["media_item_id"]:
+                logging.info("Skipping photo(already uploaded to album) -- \'{}\'".format(photo_file_name))
+                report_file_result(item, "skipped", {"id": record["media_item_id"]})
+                progress.file_done(stat.st_size)
                 continue
 
-   
-            session.headers["X-Goog-Upload-File-Name"] = os.path.basename(photo_file_name)
+            # Upload token of a file that was uploaded but never added to
+            # album is still valid for a while, no need to send bytes again.
+            if record and record["upload_token"] and (time.time() - record["uploaded"]) < UPLOAD_TOKEN_MAX_AGE:
+                item["upload_token"] = record["upload_token"]
+                item["sha256"] = record["sha256"]
+                progress.file_done(stat.st_size)
+
+            self.waiting["large" if stat.st_size > self.chunk_size else "small"].append(item)
+
+    # Submit upload of next file waiting in lane, unless file contents it
+    # holds in memory, at most one chunk, take more than max_bytes. Returns
+    # bytes taken by the submitted file, or None if none was submitted.
+    def submit_next(self, executor, lane, max_bytes):
+        self.read_ahead(lane)
+        if not self.waiting[lane]:
+            return None
 
-            logging.info("Uploading photo -- \'{}\'".format(photo_file_name))
+        item = self.waiting[lane][0]
+        cost = 0 if item.get("upload_token") else min(item["stat"].st_size, self.chunk_size)
+        if cost > max_bytes:
+            return None
+        self.waiting[lane].popleft()
 
-            #upload item 
-            upload_token = session.post('https://photoslibrary.googleapis.com/v1/uploads', photo_bytes)
+        if item.get("upload_token"):
+            future = Future()
+            future.set_result(item)
+        else:
+            if self.optimizer:
+                item["optimized"] = self.optimizer.submit(item["file"])
+            future = executor.submit(upload_worker, self.session, item, self.album_id, self.album_name, self.chunk_size, self.state, self.hash_files, self.optimizer)
+
+        self.pending[lane].append((future, item, cost))
+        self.bytes_in_flight += cost
+        return cost
+
+    def running(self):
+        return [future for lane in UPLOAD_LANES for future, _, _ in self.pending[lane] if not future.done()]
+
+    # Commit finished uploads at the head of each lane. Once the last small
+    # file is done, batches are committed without waiting to be filled by
+    # large files still uploading.
+    def harvest(self):
+        for lane in UPLOAD_LANES:
+            pending = self.pending[lane]
+            while pending and pending[0][0].done():
+                future, item, cost = pending.popleft()
+                self.bytes_in_flight -= cost
+                commit_finished_upload(self.session, self.album_id, self.album_name, self.batch, self.add_batch, self.state, future, item)
+
+        if not self.small_done and self.exhausted and not self.waiting["small"] and not self.pending["small"]:
+            self.small_done = True
+            if self.waiting["large"] or self.pending["large"]:
+                self.finish()
+
+    def done(self):
+        return self.exhausted and not any(self.waiting.values()) and not any(self.pending.values())
+
+    def finish(self):
+        if self.batch:
+            commit_batch(self.session, self.album_id, self.album_name, self.batch, self.state)
+            self.batch = []
+        if self.add_batch:
+            add_media_items(self.session, self.album_id, self.album_name, self.add_batch, self.state)
+            self.add_batch = []
+
+
+# Number of large file lane workers that go with 'jobs' small file lane
+# workers, large_jobs if it is given.
+def getLargeJobs(jobs, large_jobs=0):
+    return large_jobs or max(1, jobs // LARGE_JOBS_RATIO)
+
+
+# Upload several albums at once. Albums is an iterable of (album_name, files)
+# pairs, at most max_albums_in_flight of them are open at a time. All open
+# albums share two pools of upload workers, 'jobs' workers for small files
+# and 'large_jobs' workers for files sent in chunks, and get free workers of
+# each pool in turn, one file each, so a small album is not held up by an
+# album of large videos. At most twice as many files as workers are queued in
+# each lane, and their contents in memory, counting one chunk of each large
+# file, are kept under max_bytes_in_flight unless it's a single file. Upload
+# tokens are committed with one batchCreate call per MAX_BATCH_CREATE files.
+# Returns False if an album could not be created.
+def syncAlbums(session, albums, jobs=1, max_albums_in_flight=1, chunk_size=DEFAULT_CHUNK_SIZE, state=None, reconcile=False, hash_files=False, optimizer=None, catalog=None, on_result=None,
+               large_jobs=0, max_bytes_in_flight=DEFAULT_MAX_IN_FLIGHT):
+
+    albums = iter(albums)
+    open_albums = deque()
+    large_jobs = getLargeJobs(jobs, large_jobs)
+    result = True
+
+    with ThreadPoolExecutor(max_workers=jobs) as small_executor, ThreadPoolExecutor(max_workers=large_jobs) as large_executor:
+        lanes = (("small", small_executor, 2 * jobs), ("large", large_executor, 2 * large_jobs))
+
+        while True:
+
+            while albums is not None and len(open_albums) < max_albums_in_flight:
+                entry = next(albums, None)
+                if entry is None:
+                    albums = None
+                    break
+
+                album_name, files = entry
+                # Files given as a dict map to their creation time, it is not read again.
+                creation_times = files if isinstance(files, dict) else None
+                files = iter(files)
+
+                # Don't create album when there is nothing to upload into it.
+                first_file = next(files, None)
+                if first_file is None:
+                    continue
+
+                album_id = create_or_retrieve_album(session, album_name) if album_name else None
+
+                # interrupt upload if an upload was requested but could not be created
+                if album_name and not album_id:
+                    result = False
+                    if on_result:
+                        for file_name in itertools.chain([first_file], files):
+                            on_result(album_name, str(file_name), "failed", None)
+                    continue
+
+                open_albums.append(AlbumUpload(session, album_name, album_id, itertools.chain([first_file], files),
+                                               chunk_size, state, reconcile, hash_files, optimizer, catalog, on_result, creation_times))
+
+            if not open_albums:
+                break
+
+            # Fill free upload slots of each lane, one file from each open album in turn.
+            for lane, executor, max_pending in lanes:
+                in_flight = sum(len(album.pending[lane]) for album in open_albums)
+                idle = 0
+                while in_flight < max_pending and idle < len(open_albums):
+                    bytes_in_flight = sum(album.bytes_in_flight for album in open_albums)
+                    max_bytes = max_bytes_in_flight - bytes_in_flight if bytes_in_flight else float("inf")
+                    album = open_albums[0]
+                    open_albums.rotate(-1)
+                    if album.submit_next(executor, lane, max_bytes) is not None:
+                        in_flight += 1
+                        idle = 0
+                    else:
+                        idle += 1
 
-            if (upload_token.status_code == 200) and (upload_token.content):
+            running = [f for album in open_albums for f in album.running()]
+            if running:
+                wait(running, return_when=FIRST_COMPLETED)
 
-                create_body = json.dumps({"albumId":album_id, "newMediaItems":[{"description":"","simpleMediaItem":{"uploadToken":upload_token.content.decode()}}]}, indent=4)
-                # add item to album
-                resp = session.post('https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate', create_body).json()
+            for album in list(open_albums):
+                album.harvest()
+                if album.done():
+                    album.finish()
+                    open_albums.remove(album)
 
-                logging.debug("Server response: {}".format(resp))
+    return result
 
-                if "newMediaItemResults" in resp:
-                    status = resp["newMediaItemResults"][0]["status"]
-                    if status.get("code") and (status.get("code") > 0):
-                        logging.error("Could not add \'{0}\' to library -- {1}".format(os.path.basename(photo_file_name), status["message"]))
-                    else:
-                        logging.info("Added \'{}\' to library and album \'{}\' ".format(os.path.basename(photo_file_name), album_name))
-                        productUrl = resp["newMediaItemResults"][0]["mediaItem"]["productUrl"]
-                        filename = resp["newMediaItemResults"][0]["mediaItem"]["filename"]
-                        print("{} URL: {}".format(filename,productUrl))
 
-                    # Insert creation time into item description
-                    try:
-                        creation_date = getFileCreationDate(photo_file_name)
-                        descr = album_name + ' @' + creation_date 
-                        setDescription(session, resp["newMediaItemResults"][0]["mediaItem"]["id"], descr)
-                    except ValueError as exp:
-                        print ("Error", exp) 
-                    ####    
-                else:
-                    logging.error("Could not add \'{0}\' to library. Server Response -- {1}".format(os.path.basename(photo_file_name), resp))
+def upload_photos(session, photo_file_list, album_name, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE, state=None, reconcile=False, hash_files=False, optimizer=None, catalog=None, on_result=None,
+                  large_jobs=0, max_bytes_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    return syncAlbums(session, [(album_name, photo_file_list)], jobs, 1, chunk_size, state, reconcile, hash_files, optimizer, catalog, on_result,
+                      large_jobs, max_bytes_in_flight)
 
+def read_uint(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated header")
+    return int.from_bytes(data, "big")
 
-            else:
-                logging.error("Could not upload \'{0}\'. Server Response - {1}".format(os.path.basename(photo_file_name), upload_token))
 
+# Returns date of EXIF (TIFF) structure that starts at offset base of file f,
+# DateTimeOriginal or DateTimeDigitized of its Exif IFD, or DateTime of IFD0.
+def readExifDate(f, base):
+    f.seek(base)
+    header = f.read(8)
+    if header[:4] == b"II*\x00":
+        order = "<"
+    elif header[:4] == b"MM\x00*":
+        order = ">"
+    else:
+        return None
+
+    def read_ifd(offset):
+        f.seek(base + offset)
+        count, = struct.unpack(order + "H", f.read(2))
+        data = f.read(12 * min(count, 1024))
+        entries = {}
+        for i in range(0, len(data) - 11, 12):
+            tag, kind, length, value = struct.unpack(order + "HHII", data[i:i + 12])
+            entries[tag] = (kind, length, value)
+        return entries
+
+    # Dates are 'YYYY:MM:DD HH:MM:SS' ASCII strings, stored at offset value.
+    def read_date(entry):
+        kind, length, value = entry
+        if kind != 2 or length < 19:
+            return None
+        f.seek(base + value)
+        try:
+            return datetime.strptime(f.read(19).decode("ascii"), "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            return None
+
+    ifd0 = read_ifd(struct.unpack(order + "I", header[4:])[0])
+    entries = []
+    if 0x8769 in ifd0:
+        exif_ifd = read_ifd(ifd0[0x8769][2])
+        entries += [exif_ifd.get(0x9003), exif_ifd.get(0x9004)]
+    entries.append(ifd0.get(0x0132))
+
+    for entry in entries:
+        date = entry and read_date(entry)
+        if date:
+            return date
+    return None
+
+
+# Returns EXIF date of a JPEG file from its APP1 segment. Only segment headers
+# are read until it is found.
+def readJpegDate(f):
+    offset = 2
+    while offset < CAPTURE_SCAN_LIMIT:
+        f.seek(offset)
+        header = f.read(4)
+        if len(header) < 4 or header[0] != 0xFF or header[1] in (0xD9, 0xDA):
+            return None
+        if header[1] == 0xE1 and f.read(6) == b"Exif\x00\x00":
+            return readExifDate(f, offset + 10)
+        offset += 2 + struct.unpack(">H", header[2:])[0]
+    return None
+
+
+# Generator of (type, payload start, end) of ISO base media (QuickTime, MP4,
+# HEIF) boxes between offsets start and end of file f, reading only their
+# headers. End None is end of file.
+def iterBoxes(f, start, end):
+    offset = start
+    while end is None or offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack(">I4s", header)
+        payload = offset + 8
+        if size == 1:
+            size = read_uint(f, 8)
+            payload += 8
+        elif size == 0:
+            yield kind, payload, end
+            return
+        if offset + size < payload:
+            return
+        yield kind, payload, offset + size
+        offset += size
+
+
+# Returns file offset of EXIF (TIFF) structure of a HEIF image, from 'meta'
+# box payload between start and end, or None if it has no Exif item.
+def readHeifExifOffset(f, start, end):
+    exif_items = []
+    locations = {}
+
+    for kind, box_start, box_end in iterBoxes(f, start, end):
+        f.seek(box_start)
+        if kind == b"iinf":
+            version = read_uint(f, 4) >> 24
+            read_uint(f, 2 if version == 0 else 4)
+            for kind, infe_start, _ in iterBoxes(f, f.tell(), box_end):
+                f.seek(infe_start)
+                version = read_uint(f, 4) >> 24
+                if kind != b"infe" or version < 2:
+                    continue
+                item_id = read_uint(f, 2 if version == 2 else 4)
+                read_uint(f, 2)
+                if f.read(4) == b"Exif":
+                    exif_items.append(item_id)
+        elif kind == b"iloc":
+            version = read_uint(f, 4) >> 24
+            sizes = read_uint(f, 2)
+            offset_size, length_size, base_offset_size = sizes >> 12, (sizes >> 8) & 15, (sizes >> 4) & 15
+            index_size = sizes & 15 if version in (1, 2) else 0
+            for _ in range(read_uint(f, 2 if version < 2 else 4)):
+                if f.tell() >= box_end:
+                    break
+                item_id = read_uint(f, 2 if version < 2 else 4)
+                if version in (1, 2):
+                    read_uint(f, 2)
+                read_uint(f, 2)
+                base_offset = read_uint(f, base_offset_size)
+                extents = []
+                for _ in range(read_uint(f, 2)):
+                    read_uint(f, index_size)
+                    extents.append(base_offset + read_uint(f, offset_size))
+                    read_uint(f, length_size)
+                if extents:
+                    locations[item_id] = extents[0]
+
+    for item_id in exif_items:
+        if item_id in locations:
+            # Exif item starts with offset of TIFF header after this field.
+            f.seek(locations[item_id])
+            return locations[item_id] + 4 + read_uint(f, 4)
+    return None
+
+
+# Returns creation time of 'mvhd' box of a QuickTime or MP4 file, in local
+# time, or EXIF date of a HEIF image.
+def readIsoDate(f):
+    for kind, start, end in iterBoxes(f, 0, None):
+        if kind == b"moov":
+            for kind, start, end in iterBoxes(f, start, end):
+                if kind == b"mvhd":
+                    f.seek(start)
+                    version = read_uint(f, 4) >> 24
+                    seconds = read_uint(f, 8 if version == 1 else 4)
+                    if seconds <= QUICKTIME_EPOCH:
+                        return None
+                    utc = datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=seconds - QUICKTIME_EPOCH)
+                    return utc.astimezone().replace(tzinfo=None)
+            return None
+        elif kind == b"meta":
+            offset = readHeifExifOffset(f, start + 4, end)
+            if offset is not None:
+                return readExifDate(f, offset)
+    return None
+
+
+# Returns capture time of a photo or video from its EXIF or QuickTime header,
+# or None if it has none. Only headers are read, never the whole file.
+def getCaptureTime(file_path):
     try:
-        del(session.headers["Content-type"])
-        del(session.headers["X-Goog-Upload-Protocol"])
-        del(session.headers["X-Goog-Upload-File-Name"])
-    except KeyError:
-        pass
-        
-    return True
+        with open(file_path, 'rb') as f:
+            head = f.read(8)
+            if head[:2] == b"\xff\xd8":
+                return readJpegDate(f)
+            elif head[:4] in (b"II*\x00", b"MM\x00*"):
+                return readExifDate(f, 0)
+            elif head[4:8] in ISO_BOX_TYPES:
+                return readIsoDate(f)
+    except (OSError, ValueError, OverflowError, struct.error) as err:
+        logging.warning("Could not read capture time from header of \'{0}\' -- {1}".format(file_path, err))
+    return None
+
+
+# returns the file's creation time, capture time from its header if it has
+# one, otherwise earliest of its stat times (of stat, if it is given)
+def getFileCreationTime(file_path, stat=None):
+    capture_time = getCaptureTime(file_path)
+    if capture_time:
+        return capture_time
 
-# returns string containing the file's creation date
-def getFileCreationDate(file_path):
     try:
-        stat = os.stat(file_path)
+        stat = stat or os.stat(file_path)
     except OSError as err:
         logging.error("Could not get stat for  \'{0}\' -- {1}".format(file_path, err))
         raise ValueError("Can't get stat for file")
@@ -329,131 +2499,1163 @@ def getFileCreationDate(file_path):
     early_time = min(stat.st_atime,stat.st_mtime,stat.st_ctime)
     if early_time == 0:
          raise ValueError("File has 0 creation time")
-    res=datetime.fromtimestamp(early_time).strftime("%Y-%m-%d %H:%M:%S")
-    return res    
+    return datetime.fromtimestamp(early_time)
 
 
-#set description to file
-def setDescription(session, media_item_id, description):
-    params = {
-        'updateMask': 'description'
-    }
-    url = 'https://photoslibrary.googleapis.com/v1/mediaItems/' + media_item_id
+# returns string containing the file's creation date, creation_time if it is
+# already known
+def getFileCreationDate(file_path, stat=None, creation_time=None):
+    return (creation_time or getFileCreationTime(file_path, stat)).strftime("%Y-%m-%d %H:%M:%S")
 
-    # Unfortunetely API doesn't allow to change creation time.
-    create_body = json.dumps( { "description": description ,
-                                #"mediaMetadata": { "creationTime":"2014-10-02T15:01:23Z"}
-                              }, 
-                              indent=4)
-    resp = session.patch(url, params=params,data=create_body).json()
-    #print(resp)
 
-    
+# List one directory, returns media files that can be uploaded and
+# subdirectories to scan next. Runs on a scanner thread.
+def scanFolder(folder_path, exclude):
+    files = []
+    folders = []
 
+    try:
+        with os.scandir(folder_path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError as err:
+        logging.error("Could not list folder \'{0}\' -- {1}".format(folder_path, err))
+        return files, folders
 
+    for entry in entries:
+        if exclude and exclude.search(entry.path):
+            continue
 
-def getFilesInFolder(folder_path,exclude):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+                continue
 
-    #gphotos can only deal with (according to docs):
-    #Photos:	BMP, GIF, HEIC, ICO, JPG, PNG, TIFF, WEBP, some RAW files.	200 MB
-    #Videos:	3GP, 3G2, ASF, AVI, DIVX, M2T, M2TS, M4V, MKV, MMV, MOD, MOV, MP4, MPG, MTS, TOD, WMV.	10 GB
+            size_limit = MEDIA_SIZE_LIMITS.get(os.path.splitext(entry.name)[1].lower())
+            if size_limit is None or not entry.is_file():
+                continue
 
-    regex = r'\.(BMP|GIF|HEIC|ICO|JPG|PNG|TIFF|WEBP|RAW|3GP|3G2|ASF|AVI|DIVX|M2T|M2TS|M4V|MKV|MMV|MOD|MOV|MP4|MPG|MTS|TOD|WMV)$'
-    result = []
-    for file in list(Path(folder_path).rglob("*")):
-        if not (exclude and re.search(exclude, str(file),re.IGNORECASE)): 
-            if file and re.search(regex, str(file),re.IGNORECASE):
-                result.append(file)
+            if entry.stat().st_size > size_limit:
+                logging.warning("Skipping file(larger than {0} MB) -- \'{1}\'".format(size_limit // (1024 * 1024), entry.path))
+                continue
+            progress.add_total(entry.stat().st_size)
+        except OSError as err:
+            logging.error("Could not get stat for  \'{0}\' -- {1}".format(entry.path, err))
+            continue
+
+        files.append(entry.path)
+
+    return files, folders
 
-    return result
 
+# Generator to loop through all media files under folder_path. Folders are
+# listed in parallel and files are yielded as soon as their folder is listed,
+# so upload can start before whole tree is walked. Paths matching exclude, a
+# compiled pattern or None, are skipped.
+def getFilesInFolder(folder_path, exclude, scan_jobs=SCAN_JOBS):
 
-def getFolderList(root_path):
+    with ThreadPoolExecutor(max_workers=scan_jobs) as executor:
+        pending = {executor.submit(scanFolder, folder_path, exclude)}
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, folders = future.result()
+                for folder in folders:
+                    pending.add(executor.submit(scanFolder, folder, exclude))
+                yield from files
+
+
+def getFolderList(root_path, exclude=None):
     #one level under root is list of our albums
-    result = next(os.walk(root_path))[1]
+    with os.scandir(root_path) as it:
+        result = sorted(e.name for e in it if e.is_dir() and not (exclude and exclude.search(e.path)))
     return result    
 
 
-def uploadToAlbums(session, root_path, exclude):
-    album_list = getFolderList(root_path)
-    for album in album_list:
-        files = getFilesInFolder(root_path + '/' + album, exclude )
-        if files:
-            upload_photos(session, files, album)
+# Upload every folder one level under root_path into album of the same name,
+# up to max_albums_in_flight albums at a time. Keyword arguments are passed to
+# syncAlbums.
+def uploadToAlbums(session, root_path, exclude, max_albums_in_flight=1, **upload_options):
+    album_list = getFolderList(root_path, exclude)
+    albums = ((album, getFilesInFolder(os.path.join(root_path, album), exclude)) for album in album_list)
+    return syncAlbums(session, albums, max_albums_in_flight=max_albums_in_flight, **upload_options)
 
 
-def getAlbumContent(session,album_id):
+# Group files into albums named by their creation time formatted with
+# album_format, e.g. '%Y-%m' for an album per month. Headers of scan_jobs files
+# are read at a time. Generator of (album_name, {file: creation_time}) pairs,
+# sorted by album name within each STREAM_BATCH_SIZE files, so upload starts
+# before all files are read and an album can come more than once.
+def getDateAlbums(files, album_format, scan_jobs=DATE_SCAN_JOBS):
+    files = iter(files)
+
+    def creation_time(file_path):
+        try:
+            return getFileCreationTime(file_path)
+        except ValueError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=scan_jobs) as executor:
+        for chunk in iter(lambda: list(itertools.islice(files, STREAM_BATCH_SIZE)), []):
+            albums = {}
+            with metrics.timer("scan"):
+                times = list(executor.map(creation_time, chunk))
+            for file_path, file_time in zip(chunk, times):
+                if file_time is None:
+                    logging.error("Could not get creation time, not uploaded -- \'{}\'".format(file_path))
+                    metrics.count("files", result="failed")
+                    continue
+                albums.setdefault(file_time.strftime(album_format), {})[file_path] = file_time
+            yield from sorted(albums.items())
+
+
+# Upload files into albums by their creation time, see getDateAlbums, up to
+# max_albums_in_flight albums at a time. Keyword arguments are passed to
+# syncAlbums.
+def uploadByDate(session, files, album_format, max_albums_in_flight=1, **upload_options):
+    albums = getDateAlbums(files, album_format)
+    return syncAlbums(session, albums, max_albums_in_flight=max_albums_in_flight, **upload_options)
+
+
+# Minimal inotify binding through libc, used by watchFolders on Linux. Raises
+# OSError where inotify is not available.
+class InotifyWatcher:
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        libc_name = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or not libc_name:
+            raise OSError("inotify is not available on this system")
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.get_errno = ctypes.get_errno
+        self.paths = {}
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(self.get_errno(), "Could not watch folder \'{}\'".format(path))
+        self.paths[wd] = path
+
+    # Wait up to timeout seconds (None is forever) for events, returns list
+    # of (path, mask) tuples.
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            folder = self.paths.get(wd)
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif folder is not None:
+                events.append((os.path.join(folder, os.fsdecode(name)) if name else folder, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Album a file under root_path belongs to, name of the first folder under
+# root, or None for files directly in root.
+def getAlbumOfFile(root_path, file_path):
+    parts = os.path.relpath(file_path, root_path).split(os.sep)
+    return parts[0] if len(parts) > 1 and parts[0] != os.pardir else None
+
+
+# Keep uploading new files under root_path, in the same album layout that
+# uploadToAlbums expects, until interrupted. Changes are noticed with inotify
+# where available and by scanning every poll_interval seconds otherwise. A
+# file is uploaded once its size and mtime have not changed for 'settle'
+# seconds, files that settle together are uploaded together through the same
+# session and album index. Keyword arguments are passed to syncAlbums.
+def watchFolders(session, root_path, exclude, settle=DEFAULT_SETTLE, poll_interval=DEFAULT_POLL_INTERVAL, max_albums_in_flight=1, **upload_options):
+    # path -> (size, mtime_ns, time of last change) of files waiting to settle
+    candidates = {}
+    # path -> (size, mtime_ns) of files seen by last full scan, polling only
+    known = {}
+
+    def is_media(path):
+        return MEDIA_SIZE_LIMITS.get(os.path.splitext(path)[1].lower()) is not None and \
+            not (exclude and exclude.search(path)) and getAlbumOfFile(root_path, path) is not None
+
+    def note(path, now):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            candidates.pop(path, None)
+            return
+        entry = candidates.get(path)
+        if entry is None or entry[:2] != (stat.st_size, stat.st_mtime_ns):
+            candidates[path] = (stat.st_size, stat.st_mtime_ns, now)
+
+    def scan(folder, now):
+        for path in getFilesInFolder(folder, exclude):
+            if getAlbumOfFile(root_path, path) is None:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+                known[path] = (stat.st_size, stat.st_mtime_ns)
+                note(path, now)
+
+    def watch_tree(folder):
+        watcher.add(folder)
+        for dir_path, dir_names, _ in os.walk(folder):
+            dir_names[:] = [d for d in dir_names if not (exclude and exclude.search(os.path.join(dir_path, d)))]
+            for d in dir_names:
+                watcher.add(os.path.join(dir_path, d))
+
+    try:
+        watcher = InotifyWatcher()
+        watch_tree(root_path)
+        logging.info("Watching \'{}\' with inotify".format(root_path))
+    except OSError as err:
+        logging.warning("Watching \'{}\' by scanning every {} seconds -- {}".format(root_path, poll_interval, err))
+        watcher = None
+
+    # Files already there when watch starts are uploaded too, local state
+    # skips those that were uploaded before.
+    scan(root_path, time.monotonic())
+    if watcher:
+        known.clear()
+    next_poll = time.monotonic() + poll_interval
+
+    try:
+        while True:
+            now = time.monotonic()
+            timeout = min([c[2] + settle - now for c in candidates.values()], default=None)
+            if watcher is None:
+                timeout = min(timeout if timeout is not None else poll_interval, next_poll - now)
+            if timeout is not None:
+                timeout = max(0, timeout)
+
+            if watcher:
+                for path, mask in watcher.read(timeout):
+                    now = time.monotonic()
+                    if path is None:
+                        logging.warning("Too many changes at once, scanning \'{}\' again".format(root_path))
+                        scan(root_path, now)
+                        known.clear()
+                    elif mask & InotifyWatcher.IN_ISDIR:
+                        if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO) and not (exclude and exclude.search(path)):
+                            try:
+                                watch_tree(path)
+                            except OSError as err:
+                                logging.error("Could not watch folder \'{0}\' -- {1}".format(path, err))
+                            scan(path, now)
+                            known.clear()
+                    elif is_media(path):
+                        note(path, now)
+            else:
+                time.sleep(timeout or 0)
+                now = time.monotonic()
+                if now >= next_poll:
+                    scan(root_path, now)
+                    next_poll = now + poll_interval
+
+            # Files that didn't change for 'settle' seconds are ready, unless
+            # they changed without an event, then they wait some more.
+            now = time.monotonic()
+            ready = {}
+            for path, (size, mtime_ns, changed) in list(candidates.items()):
+                if now - changed < settle:
+                    continue
+                note(path, now)
+                if candidates.get(path) != (size, mtime_ns, changed):
+                    continue
+                del candidates[path]
+                size_limit = MEDIA_SIZE_LIMITS.get(os.path.splitext(path)[1].lower())
+                if size > size_limit:
+                    logging.warning("Skipping file(larger than {0} MB) -- \'{1}\'".format(size_limit // (1024 * 1024), path))
+                    continue
+                ready.setdefault(getAlbumOfFile(root_path, path), {})[path] = (size, mtime_ns)
+
+            # Files of albums that could not be created are tried again after
+            # poll_interval seconds.
+            albums = []
+            for album, files in sorted(ready.items()):
+                if create_or_retrieve_album(session, album):
+                    albums.append((album, sorted(files)))
+                    continue
+                logging.warning("Retrying {} files of album \'{}\' in {} seconds".format(len(files), album, poll_interval))
+                for path, (size, mtime_ns) in files.items():
+                    candidates.setdefault(path, (size, mtime_ns, now + poll_interval - settle))
+
+            if albums:
+                logging.info("Uploading {} new files".format(sum(len(files) for _, files in albums)))
+                syncAlbums(session, albums, max_albums_in_flight=max_albums_in_flight, **upload_options)
+                # Album content only needs to be listed once, new files are recorded in state as they are uploaded.
+                upload_options["reconcile"] = False
+
+    except KeyboardInterrupt:
+        logging.info("Stopped watching \'{}\'".format(root_path))
+    finally:
+        if watcher:
+            watcher.close()
+
+    return True
+
+
+# Generator of (album_name, file_name) from a binary stream of NUL separated
+# 'album<TAB>path' records. Malformed records are logged and counted as failed.
+def readRecords(stream):
+    buffer = b""
+    while True:
+        block = stream.read1(64 * 1024) if hasattr(stream, "read1") else stream.read(64 * 1024)
+        records = (buffer + block).split(b"\0")
+        # Last record is complete only at end of stream.
+        buffer = records.pop() if block else b""
+
+        for record in records:
+            if not record.strip(b"\r\n"):
+                continue
+            album, separator, path = record.strip(b"\r\n").partition(b"\t")
+            try:
+                album = album.decode("utf-8")
+            except UnicodeDecodeError:
+                album = ""
+            if not separator or not album or not path:
+                logging.error("Malformed record, expected \'album<TAB>path\' -- {}".format(record))
+                metrics.count("files", result="failed")
+                continue
+            yield album, os.fsdecode(path)
+
+        if not block:
+            return
+
+
+# Upload files listed on stream as NUL separated 'album<TAB>path' records,
+# all through the same session and album index. Records are read on another
+# thread, so a slow writer doesn't hold back files already listed: whatever
+# arrived while previous files were being uploaded is uploaded next, grouped
+# by album. Keyword arguments are passed to syncAlbums.
+def uploadFromStream(session, stream, max_albums_in_flight=1, **upload_options):
+    records = queue.Queue(maxsize=STREAM_BATCH_SIZE)
+
+    def read_stream():
+        try:
+            for record in readRecords(stream):
+                records.put(record)
+        except OSError as err:
+            logging.error("Could not read records -- {}".format(err))
+        finally:
+            records.put(None)
+
+    threading.Thread(target=read_stream, name="stdin", daemon=True).start()
+
+    return uploadRecords(session, records, max_albums_in_flight, **upload_options)
+
+
+# Upload (album_name, file_name) records taken from records queue until it
+# gives None. Whatever is queued while previous files are being uploaded is
+# uploaded next, grouped by album. Keyword arguments are passed to syncAlbums.
+def uploadRecords(session, records, max_albums_in_flight=1, **upload_options):
+    result = True
+    record = records.get()
+    while record is not None:
+        albums = {}
+        for _ in range(STREAM_BATCH_SIZE):
+            album, file_name = record
+            # A file listed twice is uploaded once, local state doesn't know
+            # about the first copy before it is committed.
+            albums.setdefault(album, {}).setdefault(os.path.abspath(file_name), file_name)
+            try:
+                record = records.get_nowait()
+            except queue.Empty:
+                record = False
+                break
+            if record is None:
+                break
+
+        albums = [(album, list(files.values())) for album, files in albums.items()]
+        if syncAlbums(session, albums, max_albums_in_flight=max_albums_in_flight, **upload_options) == False:
+            result = False
+
+        if record is False:
+            record = records.get()
+
+    return result
+
+
+# Error raised by GPhotoClient.
+class GPhotoError(Exception):
+    pass
+
+
+# Uploader for a long running process, e.g. an ingest service, to use instead
+# of running gphoto.py for each batch. It keeps one authorized session, album
+# index and upload state for its lifetime. Files of all submitted batches are
+# uploaded by one background thread, whatever was submitted meanwhile next,
+# grouped by album. Methods can be called from any thread, results are
+# returned and nothing is printed:
+#
+#   with GPhotoClient("token.json", jobs=4) as client:
+#       for r in client.upload(["a.jpg", "b.jpg"], "Album"):
+#           print(r["file"], r["result"], r["media_item"] and r["media_item"]["id"])
+#
+# Token file has to exist already, it is created by 'gphoto.py --auth'. Upload
+# state is kept in memory, unless state_file is given, so a file is uploaded
+# to an album only once for the lifetime of client.
+class GPhotoClient:
+
+    def __init__(self, token_file, state_file=None, jobs=1, max_albums_in_flight=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                 hash_files=False, timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT), upload_timeout=None,
+                 large_jobs=0, max_bytes_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        large_jobs = getLargeJobs(jobs, large_jobs)
+        self.session = get_authorized_session(None, token_file, jobs + large_jobs + 1, timeout, upload_timeout)
+        if self.session is None:
+            raise GPhotoError("Could not load auth tokens from \'{}\'".format(token_file))
+
+        try:
+            self.state = UploadState(state_file or ":memory:")
+        except sqlite3.Error as err:
+            raise GPhotoError("Could not open state file \'{}\' -- {}".format(state_file, err)) from err
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.records = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="gphoto-client", daemon=True,
+                                       args=(max_albums_in_flight, dict(jobs=jobs, large_jobs=large_jobs, max_bytes_in_flight=max_bytes_in_flight,
+                                                                        chunk_size=chunk_size, hash_files=hash_files)))
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self, max_albums_in_flight, upload_options):
+        try:
+            uploadRecords(self.session, self.records, max_albums_in_flight, state=self.state, on_result=self._on_result, **upload_options)
+            error = GPhotoError("Client was closed before upload finished")
+        except Exception as err:
+            logging.exception("Upload thread failed")
+            error = GPhotoError("Upload failed -- {}".format(err))
+            error.__cause__ = err
+
+        # Whatever is still pending now will never finish.
+        with self.lock:
+            self.closed = True
+            batches = {id(batch): batch for entries in self.pending.values() for batch, _ in entries}
+            self.pending.clear()
+        for batch in batches.values():
+            batch["future"].set_exception(error)
+
+    # Result of a file is the result of every submission of it that is still
+    # pending, it was uploaded once for all of them.
+    def _on_result(self, album_name, file_name, result, media_item):
+        finished = []
+        with self.lock:
+            for batch, index in self.pending.pop((album_name, os.path.abspath(file_name)), ()):
+                batch["results"][index].update(result=result, media_item=media_item)
+                batch["left"] -= 1
+                if batch["left"] == 0:
+                    finished.append(batch)
+        for batch in finished:
+            batch["future"].set_result(batch["results"])
+
+    # Queue files for upload to album (or only to library if album_name is
+    # None), returns a Future of their results in order of files. Result of
+    # each file is a dict with 'file', 'album', 'result' and 'media_item',
+    # where result is 'uploaded', 'reused', 'skipped' or 'failed', and
+    # media_item is the media item in album (only its 'id' unless it was
+    # uploaded), or None if it failed. Files already pending get the result
+    # of their pending upload. Future gets GPhotoError if client is closed or
+    # its upload thread fails before all files are done.
+    def submit(self, files, album_name):
+        files = [str(file_name) for file_name in files]
+        future = Future()
+        batch = {"future": future, "left": len(files),
+                 "results": [{"file": file_name, "album": album_name, "result": None, "media_item": None} for file_name in files]}
+        if not files:
+            future.set_result([])
+            return future
+
+        with self.lock:
+            if self.closed:
+                raise GPhotoError("Client is closed")
+            for index, file_name in enumerate(files):
+                self.pending.setdefault((album_name, os.path.abspath(file_name)), []).append((batch, index))
+            for file_name in files:
+                self.records.put((album_name, file_name))
+        return future
+
+    # Upload files to album and wait for their results, see submit.
+    def upload(self, files, album_name):
+        return self.submit(files, album_name).result()
+
+    # Id of album with given name created by this app, created if there is
+    # none yet.
+    def album_id(self, album_name):
+        album_id = create_or_retrieve_album(self.session, album_name)
+        if not album_id:
+            raise GPhotoError("Could not create or retrieve album \'{}\'".format(album_name))
+        return album_id
+
+    # Finish uploads already submitted and stop upload thread.
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.records.put(None)
+        self.thread.join()
+        self.state.close()
+
+
+# Id of album to upload queued files into. Album is recorded in work queue so
+# other workers of the same account use it too. It is created, or looked up,
+# outside of any transaction, so other workers are not blocked by API calls;
+# if two workers create it at once, the one recorded first is used by both.
+# Raises sqlite3.Error if work queue can't be read or written.
+def getQueuedAlbumId(session, work_queue, account, album_name):
+    album_id = work_queue.get_album(account, album_name)
+    if not album_id:
+        album_id = create_or_retrieve_album(session, album_name)
+        if not album_id:
+            return None
+        album_id = work_queue.add_album(account, album_name, album_id)
+    getAlbumIndex(session).add(album_name, album_id)
+    return album_id
+
+
+# Worker process of '--workers': claim batches of files from work queue and
+# upload them with syncAlbums until no files are left. Leases of claimed
+# files are extended from another thread while they upload. A file is done
+# once local state has it added to album. Keyword arguments are passed to
+# syncAlbums, state must be one of them. Returns False if work queue could
+# not be read MAX_WORK_ATTEMPTS times in a row, coordinator starts the worker
+# again.
+def uploadFromQueue(session, work_queue, account, **upload_options):
+    state = upload_options["state"]
+    owner = "{}:{}".format(socket.gethostname(), os.getpid())
+    stop = threading.Event()
+
+    def keep_leases():
+        while not stop.wait(WORK_LEASE / 3):
+            try:
+                work_queue.renew(owner)
+            except sqlite3.Error as err:
+                logging.error("Could not extend lease of claimed files -- {}".format(err))
+
+    threading.Thread(target=keep_leases, name="lease", daemon=True).start()
+
+    errors = 0
+    try:
+        while True:
+            try:
+                batch = work_queue.claim(owner)
+                if batch is None:
+                    counts = work_queue.counts()
+                    if not counts.get("queued") and not counts.get("leased"):
+                        return True
+                else:
+                    album_name, items = batch
+                    logging.info("Claimed {} files of album \'{}\'".format(len(items), album_name))
+                    album_id = getQueuedAlbumId(session, work_queue, account, album_name)
+                errors = 0
+            except sqlite3.Error as err:
+                # Files claimed are claimed again once their lease expires.
+                logging.error("Could not claim files from work queue -- {}".format(err))
+                errors += 1
+                if errors >= MAX_WORK_ATTEMPTS:
+                    return False
+                batch = None
+
+            if batch is None:
+                # Other workers have files claimed, they are claimed here if a worker dies.
+                time.sleep(1)
+                continue
+
+            if album_id:
+                syncAlbums(session, [(album_name, [path for _, path in items])], **upload_options)
+
+            done, failed = [], []
+            for work_id, path in items:
+                try:
+                    record = state.lookup(path, os.stat(path), album_id) if album_id else None
+                except OSError:
+                    record = None
+                (done if record and record["media_item_id"] else failed).append(work_id)
+            try:
+                work_queue.finish(owner, done, failed)
+            except sqlite3.Error as err:
+                # Files done are skipped by local state when claimed again.
+                logging.error("Could not mark files done in work queue -- {}".format(err))
+    finally:
+        stop.set()
+
+
+# Upload tree under root_path with worker processes: files are put in work
+# queue in queue_file, and worker_count workers, started with command given
+# by worker_command(index), claim and upload them. A worker that exits with
+# an error while files are left is started again, files it had claimed are
+# claimed again once their lease expires. Returns False if some files could
+# not be uploaded.
+def coordinateUploads(root_path, exclude, queue_file, worker_count, worker_command):
+    work_queue = WorkQueue(queue_file)
+
+    with metrics.timer("scan"):
+        for album in getFolderList(root_path, exclude):
+            files = getFilesInFolder(os.path.join(root_path, album), exclude)
+            while True:
+                chunk = []
+                for path in itertools.islice(files, STREAM_BATCH_SIZE):
+                    try:
+                        chunk.append((path, os.stat(path)))
+                    except OSError as err:
+                        logging.error("Could not read file \'{0}\' -- {1}".format(path, err))
+                if not chunk:
+                    break
+                work_queue.add(album, chunk)
+
+    counts = work_queue.counts()
+    logging.info("Queued {} files for {} workers, {} files done before".format(
+        counts.get("queued", 0) + counts.get("leased", 0), worker_count, counts.get("done", 0)))
+
+    workers = [subprocess.Popen(worker_command(i)) for i in range(worker_count)]
+    restarts = 0
+    try:
+        while any(workers):
+            time.sleep(1)
+            counts, sizes = work_queue.counts(), work_queue.sizes()
+            progress.set_counts(sum(counts.values()), sum(sizes.values()),
+                                counts.get("done", 0) + counts.get("failed", 0), sizes.get("done", 0) + sizes.get("failed", 0))
+            for i, worker in enumerate(workers):
+                if worker is None or worker.poll() is None:
+                    continue
+                counts = work_queue.counts()
+                if worker.returncode != 0 and (counts.get("queued") or counts.get("leased")) and restarts < MAX_WORK_ATTEMPTS * worker_count:
+                    logging.warning("Worker {} exited with {}, starting it again".format(i, worker.returncode))
+                    workers[i] = subprocess.Popen(worker_command(i))
+                    restarts += 1
+                else:
+                    workers[i] = None
+    finally:
+        for worker in workers:
+            if worker is not None:
+                worker.wait()
+
+    counts = work_queue.counts()
+    work_queue.close()
+    print("Workers done: {} files uploaded, {} failed, {} left".format(
+        counts.get("done", 0), counts.get("failed", 0), counts.get("queued", 0) + counts.get("leased", 0)))
+    return not counts.get("failed") and not counts.get("queued") and not counts.get("leased")
+
+
+# Generator of pages of album content, each a list of media items. Next page
+# is requested on another thread while caller works through current one.
+# Raises OSError or ValueError if a page can't be listed.
+def getAlbumContentPages(session, album_id):
     params = {
          #'excludeNonAppCreatedData': appCreatedOnly
         "pageSize": "100",
         "albumId": album_id
     }
 
-    while True:
-        resp = session.post('https://photoslibrary.googleapis.com/v1/mediaItems:search', params=params).json()
-
+    def fetch_page(page_token):
+        page_params = dict(params, pageToken=page_token) if page_token else params
+        with metrics.timer("album_content"):
+            resp = api_request(session, 'POST', API_URL + '/mediaItems:search', params=page_params).json()
         logging.debug("Server response: {}".format(resp))
+        if "error" in resp:
+            raise ValueError("Failed to list album content - {}".format(resp["error"]))
+        return resp.get("mediaItems", []), resp.get("nextPageToken")
 
-        if 'mediaItems' in resp:
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(fetch_page, None)
+        while future is not None:
+            items, page_token = future.result()
+            future = executor.submit(fetch_page, page_token) if items and page_token else None
+            if items:
+                yield items
 
-            for a in resp["mediaItems"]:
-                yield a['filename']
 
-            if 'nextPageToken' in resp:
-                params["pageToken"] = resp["nextPageToken"]
-            else:
-                return
+# Generator of media items in album, stops early if album can't be listed.
+def getAlbumContent(session,album_id):
+    try:
+        for page in getAlbumContentPages(session, album_id):
+            yield from page
+    except (OSError, ValueError) as err:
+        logging.error("Could not list album content -- {}".format(err))
+
 
+# Output lock, so concurrently listed albums are printed a page at a time.
+_print_lock = threading.Lock()
+
+
+def printMediaItems(items, as_json, album=None):
+    lines = []
+    for a in items:
+        if as_json:
+            if album is not None:
+                a = dict(a, albumId=album["id"], albumTitle=album.get("title", ""))
+            lines.append(json.dumps(a))
         else:
-            return
+            row = "{:<40} | {:>8}".format(a.get("filename", "????"), a["description"]) if "description" in a else \
+                  "{:<40} |".format(a.get("filename", "????"))
+            lines.append(row if album is None else "{:<40} | {}".format(album.get("title", ""), row))
 
-def printAlbumContent(session,album_name):
+    with _print_lock:
+        print("\n".join(lines), flush=True)
 
-    album_id = getAlbumId(session,album_name)
+
+# Print content of album, from catalog instead of server if one is given.
+def printAlbumContent(session, album_name, as_json=False, catalog=None):
+
+    album_id = catalog.find_album(album_name) if catalog else getAlbumId(session,album_name)
 
     if album_id == None:
-        print("Album not found: {}".format(album_name))
+        logging.error("Album not found: {}".format(album_name))
         return False
 
-    params = {
-         #'excludeNonAppCreatedData': appCreatedOnly
-        "pageSize": "100",
-        "albumId": album_id
-    }
+    if not as_json:
+        print("{:<40} | {:>8}".format("FILE NAME","DESCRIPTION"))
 
-    print("{:<40} | {:>8}".format("FILE NAME","DESCRIPTION"))
+    if catalog:
+        items = catalog.album_items(album_id)
+        if items:
+            printMediaItems(items, as_json)
+        return True
 
-    while True:
-        resp = session.post('https://photoslibrary.googleapis.com/v1/mediaItems:search', params=params).json()
+    try:
+        for page in getAlbumContentPages(session, album_id):
+            printMediaItems(page, as_json)
+    except (OSError, ValueError) as err:
+        logging.error("Could not list album \'{0}\' -- {1}".format(album_name, err))
+        return False
 
-        logging.debug("Server response: {}".format(resp))
+    return True
+
+
+def printAlbums(session, as_json=False, catalog=None):
+    if not as_json:
+        print("{:<50} | {:>8} | {} ".format("PHOTO ALBUM","# PHOTOS", "IS WRITEABLE?"))
+
+    for a in catalog.albums() if catalog else getAlbums(session):
+        if as_json:
+            print(json.dumps(a))
+        else:
+            print("{:<50} | {:>8} | {} ".format(a["title"],a.get("mediaItemsCount", "0"), str(a.get("isWriteable", False))))
+
+
+# Print content of every album in library, listing up to 'jobs' albums at a
+# time. Items are printed a page at a time as they arrive, so pages of
+# different albums are interleaved; with as_json each item carries 'albumId'
+# and 'albumTitle'. Returns False if an album could not be listed. With a
+# catalog, albums are printed from it one after another.
+def printLibraryContent(session, jobs=1, as_json=False, catalog=None):
+
+    def list_album(album):
+        try:
+            for page in getAlbumContentPages(session, album["id"]):
+                printMediaItems(page, as_json, album)
+        except (OSError, ValueError) as err:
+            logging.error("Could not list album \'{0}\' -- {1}".format(album.get("title"), err))
+            return False
+        return True
+
+    if not as_json:
+        print("{:<40} | {:<40} | {:>8}".format("PHOTO ALBUM", "FILE NAME","DESCRIPTION"))
+
+    if catalog:
+        for album in catalog.albums():
+            items = catalog.album_items(album["id"])
+            if items:
+                printMediaItems(items, as_json, album)
+        return True
+
+    result = True
+    pending = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for album in getAlbums(session):
+            # Albums are listed lazily, never more than 2 * jobs queued.
+            if len(pending) >= 2 * jobs:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                result = all(f.result() for f in done) and result
+            pending.add(executor.submit(list_album, album))
+
+        result = all(f.result() for f in pending) and result
+
+    return result
 
-        if 'mediaItems' in resp:
 
-            for a in resp["mediaItems"]:
-                if "filename" in a:
-                    if "description" in a:
-                        print("{:<40} | {:>8}".format(a["filename"], a["description"]))
+# URL of original bytes of media item, with '=dv' for videos and '=d' for photos.
+def getDownloadUrl(media_item):
+    is_video = media_item.get("mimeType", "").startswith("video/") or "video" in media_item.get("mediaMetadata", {})
+    return media_item["baseUrl"] + ("=dv" if is_video else "=d")
+
+
+# Name of file media item is downloaded to. Names already given to other
+# items of the album are in 'names', item's id is added to a repeated name.
+def getDownloadFileName(media_item, names):
+    file_name = os.path.basename(media_item.get("filename", "").replace("\\", "/")) or media_item["id"]
+    if file_name.lower() in names:
+        stem, ext = os.path.splitext(file_name)
+        file_name = "{}_{}{}".format(stem, media_item["id"][-8:], ext)
+    names.add(file_name.lower())
+    return file_name
+
+
+# Total size of content from Content-Range or Content-Length of response to a
+# request for bytes from offset on, or None if server didn't say.
+def getContentSize(resp, offset):
+    match = re.match(r"bytes (?:\d+-\d+|\*)/(\d+)", resp.headers.get("Content-Range", ""))
+    if match:
+        return int(match.group(1))
+    if resp.status_code == 200 and "Content-Length" in resp.headers:
+        return int(resp.headers["Content-Length"])
+    return None
+
+
+# Download media item into file_path, streamed to disk a block at a time.
+# Bytes go to 'file_path.part' which is renamed once complete, and a part
+# left by an interrupted run is resumed with a Range request. Existing file
+# is kept if its size is the size server reports, asked for with a Range
+# request past its end, otherwise it is downloaded again. Download URLs
+# expire after an hour, an expired one is renewed by getting media item
+# again. Returns True if file is downloaded or already there.
+def download_media_item(session, media_item, file_path):
+    part_path = file_path + ".part"
+    file_name = os.path.basename(file_path)
+    failures = 0
+    renewed = False
+    replace = False
+
+    while True:
+        existing = os.path.exists(file_path) and not replace
+        try:
+            offset = os.path.getsize(file_path if existing else part_path)
+        except OSError:
+            offset = 0
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+
+        try:
+            with metrics.timer("download"):
+                with api_request(session, 'GET', getDownloadUrl(media_item), endpoint="GET download", headers=headers, stream=True) as resp:
+                    size = getContentSize(resp, offset)
+
+                    if resp.status_code in (403, 404) and not renewed:
+                        renewed = True
+                        media_item = api_request(session, 'GET', API_URL + '/mediaItems/' + media_item["id"]).json()
+                        if "baseUrl" in media_item:
+                            continue
+
+                    if resp.status_code == 416 or (resp.status_code == 200 and offset and size == offset):
+                        if size is not None and size != offset:
+                            # Local copy is larger than server's, download it again.
+                            if existing:
+                                replace = True
+                            else:
+                                os.remove(part_path)
+                            continue
+                        if existing:
+                            logging.info("Skipping download(already exists) -- \'{}\'".format(file_path))
+                            metrics.count("files", result="skipped")
+                            return True
+                        break
+
+                    if resp.status_code not in (200, 206):
+                        logging.error("Could not download \'{0}\'. Server Response - {1} {2}".format(file_name, resp.status_code, resp.text[:200]))
+                        metrics.count("files", result="failed")
+                        return False
+
+                    # Existing file is smaller than server's, so it is not the same file.
+                    if existing and resp.status_code == 206:
+                        replace = True
+                        continue
+
+                    if resp.status_code == 206 and not resp.headers.get("Content-Range", "").startswith("bytes {}-".format(offset)):
+                        raise OSError("Unexpected range in response -- {}".format(resp.headers.get("Content-Range")))
+
+                    if offset and resp.status_code == 206:
+                        logging.info("Resuming download at byte {0} -- \'{1}\'".format(offset, file_path))
                     else:
-                        print("{:<40} |".format(a["filename"]))
-                else:
-                    print("{:<40} |".format("????"))
+                        logging.info("Downloading -- \'{}\'".format(file_path))
 
-            if 'nextPageToken' in resp:
-                params["pageToken"] = resp["nextPageToken"]
-            else:
-                return True
+                    with open(part_path, 'ab' if resp.status_code == 206 else 'wb') as f:
+                        for block in resp.iter_content(DOWNLOAD_BLOCK_SIZE):
+                            f.write(block)
+                            metrics.count("bytes_received", len(block))
 
-        else:
-             # TODO: Check this
-            return True
+            if size is not None and os.path.getsize(part_path) != size:
+                raise OSError("Download ended at byte {} of {}".format(os.path.getsize(part_path), size))
+            break
+
+        except (OSError, ValueError) as err:
+            failures += 1
+            if failures > MAX_CHUNK_RETRIES:
+                logging.error("Could not download \'{0}\' -- {1}".format(file_name, err))
+                metrics.count("files", result="failed")
+                return False
+            logging.warning("Retrying download -- \'{0}\' -- {1}".format(file_name, err))
+            time.sleep(retry_delay(failures - 1, None))
+
+    os.replace(part_path, file_path)
 
+    # Downloaded file gets time photo was taken.
+    try:
+        taken = datetime.fromisoformat(media_item["mediaMetadata"]["creationTime"].replace("Z", "+00:00")).timestamp()
+        os.utime(file_path, (taken, taken))
+    except (KeyError, ValueError, OSError):
+        pass
+
+    metrics.count("files", result="downloaded")
+    return True
 
-def printAlbums(session):
-    print("{:<50} | {:>8} | {} ".format("PHOTO ALBUM","# PHOTOS", "IS WRITEABLE?"))
 
-    for a in getAlbums(session):
-        print("{:<50} | {:>8} | {} ".format(a["title"],a.get("mediaItemsCount", "0"), str(a.get("isWriteable", False))))
+# Download all media items of album into dest_folder, up to 'jobs' at a time.
+# Album content is listed as downloads go, never more than 2 * jobs media
+# items are queued, so download URLs are used soon after they are listed.
+# Returns False if album could not be listed or a file not downloaded.
+def downloadAlbum(session, album_name, dest_folder, jobs=1):
+
+    album_id = getAlbumId(session, album_name)
+
+    if album_id == None:
+        print("Album not found: {}".format(album_name))
+        return False
+
+    os.makedirs(dest_folder, exist_ok=True)
+
+    result = True
+    names = set()
+    pending = set()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            for page in getAlbumContentPages(session, album_id):
+                for media_item in page:
+                    if len(pending) >= 2 * jobs:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        result = all(f.result() for f in done) and result
+                    file_path = os.path.join(dest_folder, getDownloadFileName(media_item, names))
+                    pending.add(executor.submit(download_media_item, session, media_item, file_path))
+        except (OSError, ValueError) as err:
+            logging.error("Could not list album \'{0}\' -- {1}".format(album_name, err))
+            result = False
+
+        result = all(f.result() for f in pending) and result
+
+    return result
+
+
+# Command line of a worker process of '--workers', with upload options of
+# coordinator. Requests per minute are split between workers sharing an
+# account, each has its own log and metrics file.
+def getWorkerCommand(args, queue_file, token_file, state_file, index, workers_sharing_token):
+
+    def worker_file(file_name):
+        root, ext = os.path.splitext(file_name)
+        return "{}.worker{}{}".format(root, index, ext)
+
+    command = [sys.executable, os.path.abspath(sys.argv[0]), "--up", "--no-progress", "--queue", queue_file, "--token", token_file,
+               "--state", state_file, "--jobs", str(args.jobs), "--large-jobs", str(args.large_jobs),
+               "--max-in-flight", str(args.max_in_flight), "--chunk-size", str(args.chunk_size),
+               "--connect-timeout", str(args.connect_timeout), "--read-timeout", str(args.read_timeout),
+               "--upload-timeout", str(args.upload_timeout)]
+    # Album cache file is named after folder of token file, not token file, so
+    # it is not shared between accounts.
+    if args.album_cache_ttl and not args.worker_tokens:
+        command += ["--album-cache-ttl", str(args.album_cache_ttl)]
+    if args.rpm:
+        command += ["--rpm", str(max(1, args.rpm // workers_sharing_token))]
+    # Bandwidth is shared by all workers, whatever account they upload to.
+    if args.bandwidth:
+        command += ["--bandwidth", str(args.bandwidth / args.workers)]
+    if args.bandwidth_schedule:
+        command += ["--bandwidth-schedule", ",".join("{:02d}:{:02d}-{:02d}:{:02d}={}".format(
+            start // 60, start % 60, end // 60, end % 60, (rate or args.bandwidth) / args.workers)
+            for start, end, rate in args.bandwidth_schedule)]
+    if args.hash_files:
+        command += ["--hash"]
+    # Catalog is next to token file, like album cache.
+    if args.use_catalog and not args.worker_tokens:
+        command += ["--catalog"]
+    if args.optimize:
+        command += ["--optimize", "--max-megapixels", str(args.max_megapixels), "--quality", str(args.quality)]
+    if args.print_stats:
+        command += ["--stats"]
+    if args.log_file:
+        command += ["--log", worker_file(args.log_file)]
+    if args.metrics_file:
+        command += ["--metrics-file", worker_file(args.metrics_file)]
+    return command
+
+
+# Print and write metrics of the run, as asked for in arguments.
+def report_metrics(args):
+    if args.print_stats:
+        print(metrics.summary(), file=sys.stderr)
+
+    if args.metrics_file:
+        try:
+            metrics.write(args.metrics_file)
+        except OSError as err:
+            logging.error("Could not write metrics file \'{0}\' -- {1}".format(args.metrics_file, err))
+
+
+# Run action given in already validated arguments.
+def run_action(args, client_id_file, token_file):
+
+    configureAlbumCache(os.path.join(os.path.dirname(token_file), "albums.json"), args.album_cache_ttl)
+
+    configureRateLimits(args.rpm, args.jobs + args.large_jobs)
+
+    configureBandwidth(args.bandwidth, args.bandwidth_schedule)
+
+    if args.run_upload == True and args.workers > 0:
+        queue_file = os.path.abspath(args.queue_file or os.path.join(os.path.dirname(token_file), "queue.db"))
+        state_file = os.path.abspath(args.state_file or os.path.join(os.path.dirname(token_file), "state.db"))
+        worker_tokens = args.worker_tokens or [token_file]
+        worker_command = lambda i: getWorkerCommand(args, queue_file, worker_tokens[i % len(worker_tokens)], state_file, i,
+                                                    len(range(i % len(worker_tokens), args.workers, len(worker_tokens))))
+        if args.show_progress == True:
+            progress.start(sys.stdout.isatty())
+        try:
+            result = coordinateUploads(args.root_folder, args.exclude, queue_file, args.workers, worker_command)
+        finally:
+            progress.stop()
+        if result == False:
+            sys.exit(1)
+        return
+
+    catalog_file = os.path.join(os.path.dirname(token_file), "catalog.db")
+    catalog = None
+    if args.use_catalog == True or args.refresh_catalog == True:
+        try:
+            catalog = Catalog(catalog_file)
+        except sqlite3.Error as err:
+            print("error: could not open catalog file; {}; {}".format(catalog_file, err))
+            sys.exit(1)
+
+    # Listing from catalog needs no session, it works offline.
+    if args.albums_list == True and catalog is not None:
+        session = None
+    else:
+        # Pool has a connection for each upload worker of both lanes and for
+        # main thread, or two for each album listed at a time, as next page is
+        # prefetched.
+        pool_size = 2 * args.jobs + 1 if args.albums_list == True or args.refresh_catalog == True else args.jobs + args.large_jobs + 1
+        session = get_authorized_session(client_id_file, token_file, pool_size,
+                                         (args.connect_timeout, args.read_timeout), args.upload_timeout or None)
+
+    # If action to create authentication token was requested, than it is the only thing to do (and it is done every time anyway), so exit.
+    if args.create_auth == True:
+        if session is not None:
+            print("Auth token exists and seems valid.")
+        return
+
+    if args.run_upload == True or args.watch_folder is not None:
+        state_file = args.state_file or os.path.join(os.path.dirname(token_file), "state.db")
+        try:
+            state = UploadState(os.path.abspath(state_file))
+        except sqlite3.Error as err:
+            print("error: could not open state file; {}; {}".format(state_file, err))
+            sys.exit(1)
+        upload_options = {
+            "jobs": args.jobs,
+            "large_jobs": args.large_jobs,
+            "max_bytes_in_flight": args.max_in_flight * 1024 * 1024,
+            "chunk_size": args.chunk_size * 1024 * 1024,
+            "state": state,
+            "reconcile": args.reconcile,
+            "hash_files": args.hash_files,
+            "optimizer": ImageOptimizer(args.max_megapixels, args.quality) if args.optimize else None,
+            "catalog": catalog
+        }
+        # Progress is shown for upload only, watching folders never ends.
+        if args.run_upload == True and args.show_progress == True:
+            progress.start(sys.stdout.isatty())
+        try:
+            if args.watch_folder is not None:
+                result = watchFolders(session, args.watch_folder, args.exclude, args.settle, args.poll_interval,
+                                      args.max_albums_in_flight, **upload_options)
+            elif args.from_stdin == True:
+                result = uploadFromStream(session, sys.stdin.buffer, args.max_albums_in_flight, **upload_options)
+            elif args.queue_file is not None and args.root_folder is None:
+                work_queue = WorkQueue(os.path.abspath(args.queue_file))
+                result = uploadFromQueue(session, work_queue, token_file, **upload_options)
+                work_queue.close()
+            elif args.album_by is not None:
+                files = getFilesInFolder(args.root_folder, args.exclude) if args.root_folder is not None else args.photos
+                result = uploadByDate(session, files, args.album_by, args.max_albums_in_flight, **upload_options)
+            elif args.root_folder is not None:
+                result = uploadToAlbums(session, args.root_folder, args.exclude, args.max_albums_in_flight, **upload_options)
+            else:
+                result = upload_photos(session, args.photos, args.album_name, **upload_options)
+        finally:
+            progress.stop()
+            if upload_options["optimizer"]:
+                upload_options["optimizer"].close()
+            if catalog:
+                catalog.close()
+            state.close()
+        if result == False:
+            sys.exit(1)
+        return
+
+    if args.run_download == True:
+        if downloadAlbum(session, args.album_name, args.dest_folder, args.jobs) == False:
+            sys.exit(1)
+        return
+
+    if args.refresh_catalog == True:
+        try:
+            listed, unchanged, failed = catalog.refresh(session, args.jobs)
+        except (RefreshError, OSError, ValueError) as err:
+            print("error: could not list albums; {}".format(err))
+            sys.exit(1)
+        finally:
+            album_count, item_count = catalog.counts()
+            catalog.close()
+        print("Catalog: {} albums, {} media items; {} albums listed again, {} unchanged, {} failed".format(
+            album_count, item_count, listed, unchanged, failed))
+        if failed:
+            sys.exit(1)
+        return
+
+    if args.albums_list == True:
+        if args.list_all == True:
+            if printLibraryContent(session, args.jobs, args.json_output, catalog) == False:
+                sys.exit(1)
+        elif args.album_name is None:
+            printAlbums(session, args.json_output, catalog)
+        elif args.album_name == "":
+            print("error: argument 'album'; expected non empty argument")
+            sys.exit(1)
+        else:
+            if printAlbumContent(session, args.album_name, args.json_output, catalog) == False:
+                sys.exit(1)
+        return
 
 
 def main():
@@ -470,6 +3672,15 @@ def main():
     if args.run_upload == True:
         action_count += 1
 
+    if args.watch_folder is not None:
+        action_count += 1
+
+    if args.run_download == True:
+        action_count += 1
+
+    if args.refresh_catalog == True:
+        action_count += 1
+
     if action_count == 0:
         print("Run 'gphoto.py -h' for help.")
         sys.exit(1)
@@ -522,12 +3733,172 @@ def main():
         else:
             token_file = os.path.abspath(args.token_file)
 
-    if args.create_auth == False and os.path.exists(token_file) == False:
+    if args.worker_tokens is not None:
+        if args.workers < 1:
+            print("warning: argument 'worker-token' is used only with 'workers'")
+        for worker_token in args.worker_tokens:
+            if os.path.exists(worker_token) == False:
+                print("error: no such file; {}".format(worker_token))
+                sys.exit(1)
+        args.worker_tokens = [os.path.abspath(worker_token) for worker_token in args.worker_tokens]
+
+    if args.create_auth == False and os.path.exists(token_file) == False and not (args.workers > 0 and args.worker_tokens):
         print("error: no such file; {}".format(token_file))
         sys.exit(1)
 
-    if args.run_upload == True:
-        if args.album_name is None:
+    if args.jobs < 1:
+        print("error: argument 'jobs'; expected positive number")
+        sys.exit(1)
+
+    if args.max_albums_in_flight < 1:
+        print("error: argument 'max-albums-in-flight'; expected positive number")
+        sys.exit(1)
+
+    if args.large_jobs < 0:
+        print("error: argument 'large-jobs'; expected positive number or 0")
+        sys.exit(1)
+    args.large_jobs = getLargeJobs(args.jobs, args.large_jobs)
+
+    if args.max_in_flight < 1:
+        print("error: argument 'max-in-flight'; expected positive number")
+        sys.exit(1)
+
+    if args.use_catalog == True:
+        catalog_file = os.path.join(os.path.dirname(token_file), "catalog.db")
+        if args.albums_list == False and args.run_upload == False and args.watch_folder is None:
+            print("warning: argument 'catalog' is used only with 'ls', 'up' or 'watch'")
+        elif os.path.exists(catalog_file) == False:
+            print("error: no such file; {}; run with '--refresh' first".format(catalog_file))
+            sys.exit(1)
+
+    if args.workers < 0:
+        print("error: argument 'workers'; expected positive number or 0")
+        sys.exit(1)
+
+    if args.workers > 0:
+        if args.root_folder is None:
+            print("error: argument 'workers'; expected only with 'path'")
+            sys.exit(1)
+        elif args.reconcile == True:
+            print("warning: argument 'reconcile' is not used with 'workers'")
+
+    if args.rpm < 0:
+        print("error: argument 'rpm'; expected positive number or 0")
+        sys.exit(1)
+
+    if args.bandwidth < 0:
+        print("error: argument 'bandwidth'; expected positive number or 0")
+        sys.exit(1)
+
+    if args.bandwidth_schedule is not None:
+        try:
+            args.bandwidth_schedule = parseSchedule(args.bandwidth_schedule)
+        except ValueError as err:
+            print("error: argument 'bandwidth-schedule'; expected 'HH:MM-HH:MM[=MB/s],...'; {}".format(err))
+            sys.exit(1)
+        if args.bandwidth == 0 and any(rate is None for _, _, rate in args.bandwidth_schedule):
+            print("error: argument 'bandwidth-schedule'; expected rate for each time, or 'bandwidth'")
+            sys.exit(1)
+
+    if args.connect_timeout <= 0 or args.read_timeout <= 0 or args.upload_timeout < 0:
+        print("error: arguments 'connect-timeout', 'read-timeout', 'upload-timeout'; expected positive number")
+        sys.exit(1)
+
+    if args.albums_list == False and (args.json_output == True or args.list_all == True):
+        print("warning: arguments 'json' and 'all' are used only with 'ls'")
+
+    if args.list_all == True and args.album_name is not None:
+        print("error: argument 'all'; not allowed with 'album'")
+        sys.exit(1)
+
+    if args.chunk_size < 1:
+        print("error: argument 'chunk-size'; expected positive number")
+        sys.exit(1)
+
+    if args.optimize == True:
+        if importlib.util.find_spec("PIL") is None:
+            print("error: argument 'optimize'; Pillow is not installed, run 'pip install Pillow'")
+            sys.exit(1)
+        elif args.max_megapixels <= 0 or not (1 <= args.quality <= 95):
+            print("error: arguments 'max-megapixels', 'quality'; expected positive number and quality from 1 to 95")
+            sys.exit(1)
+
+    if args.exclude is not None:
+        if args.root_folder is None and args.watch_folder is None:
+            print("warning: argument 'exclude' is used only with 'path' or 'watch'")
+        try:
+            args.exclude = re.compile(args.exclude, re.IGNORECASE)
+        except re.error as err:
+            print("error: argument 'exclude'; {}".format(err))
+            sys.exit(1)
+
+    if args.watch_folder is not None:
+        if args.album_name is not None or len(args.photos) != 0:
+            print("error: argument 'watch'; not allowed with 'album' or 'photos'")
+            sys.exit(1)
+        elif os.path.isdir(args.watch_folder) == False:
+            print("error: no such folder; {}".format(args.watch_folder))
+            sys.exit(1)
+        elif args.settle < 0 or args.poll_interval <= 0:
+            print("error: arguments 'settle', 'poll-interval'; expected positive number")
+            sys.exit(1)
+        # Stop on SIGTERM the same way as on Ctrl+C, so state is closed and metrics are reported.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    if args.run_download == True:
+        if args.album_name is None or args.album_name == "":
+            print("error: argument 'album'; expected non empty argument for download")
+            sys.exit(1)
+        elif args.dest_folder is None or args.dest_folder == "":
+            print("error: argument 'dest'; expected non empty argument for download")
+            sys.exit(1)
+        elif args.root_folder is not None or len(args.photos) != 0:
+            print("error: argument 'down'; not allowed with 'path' or 'photos'")
+            sys.exit(1)
+    elif args.dest_folder is not None:
+        print("warning: argument 'dest' is used only with 'down'")
+
+    if args.album_by is not None:
+        if args.run_upload == False or args.from_stdin == True or args.queue_file is not None or args.workers > 0:
+            print("error: argument 'album-by'; expected only for upload with 'path' or 'photos'")
+            sys.exit(1)
+        elif not args.album_by.startswith("date:") or len(args.album_by) == len("date:"):
+            print("error: argument 'album-by'; expected 'date:format'")
+            sys.exit(1)
+        args.album_by = args.album_by[len("date:"):]
+
+    if args.from_stdin == True:
+        if args.run_upload == False:
+            print("error: argument 'from-stdin'; expected only for upload")
+            sys.exit(1)
+        elif args.root_folder is not None or args.album_name is not None or len(args.photos) != 0:
+            print("error: argument 'from-stdin'; not allowed with 'path', 'album' or 'photos'")
+            sys.exit(1)
+    elif args.queue_file is not None and args.root_folder is None:
+        if args.run_upload == False:
+            print("error: argument 'queue'; expected only for upload")
+            sys.exit(1)
+        elif args.album_name is not None or len(args.photos) != 0:
+            print("error: argument 'queue'; not allowed with 'album' or 'photos'")
+            sys.exit(1)
+        elif os.path.exists(args.queue_file) == False:
+            print("error: no such file; {}".format(args.queue_file))
+            sys.exit(1)
+    elif args.root_folder is not None:
+        if args.run_upload == False:
+            print("error: argument 'path'; expected only for upload")
+            sys.exit(1)
+        elif args.album_name is not None or len(args.photos) != 0:
+            print("error: argument 'path'; not allowed with 'album' or 'photos'")
+            sys.exit(1)
+        elif os.path.isdir(args.root_folder) == False:
+            print("error: no such folder; {}".format(args.root_folder))
+            sys.exit(1)
+    elif args.run_upload == True:
+        if args.album_by is not None and args.album_name is not None:
+            print("error: argument 'album-by'; not allowed with 'album'")
+            sys.exit(1)
+        elif args.album_by is None and args.album_name is None:
             print("error: argument 'album'; expected for upload")
             sys.exit(1)
         elif args.album_name == "":
@@ -547,29 +3918,11 @@ def main():
     # End of validation.
     #
 
-    session = get_authorized_session(client_id_file, token_file)
-
-    # If action to create authentication token was requested, than it is the only thing to do (and it is done every time anyway), so exit.
-    if args.create_auth == True:
-        if session is not None:
-            print("Auth token exists and seems valid.")
-        return
+    try:
+        run_action(args, client_id_file, token_file)
+    finally:
+        report_metrics(args)
 
-    if args.run_upload == True:
-        if upload_photos(session, args.photos, args.album_name) == False:
-            sys.exit(1)
-        return
 
-    if args.albums_list == True:
-        if args.album_name is None:
-            printAlbums(session)
-        elif args.album_name == "":
-            print("error: argument 'album'; expected non empty argument")
-            sys.exit(1)
-        else:
-            if printAlbumContent(session,args.album_name) == False:
-                sys.exit(1)
-        return
-   
 if __name__ == '__main__':
   main()
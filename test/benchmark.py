@@ -0,0 +1,184 @@
+#benchmark
+#Throughput benchmark of gphoto.py upload path against test/mock_server.py.
+#Builds synthetic corpora, uploads each with 'gphoto.py --up --path' in a
+#separate process and reports files/s, MB/s, API calls per file and peak RSS:
+#
+#   python test/benchmark.py --corpus all --jobs 8 --latency 50 --bandwidth 20
+#
+#Extra arguments after '--' are passed to gphoto.py, so runs with different
+#options can be compared, e.g. 'python test/benchmark.py -- --chunk-size 4'.
+
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import os.path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_server
+
+GPHOTO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gphoto.py")
+CORPORA = ("small", "huge", "mixed")
+
+
+def parse_args(arg_input=None):
+    parser = argparse.ArgumentParser(description="Benchmark gphoto.py uploads against a local mock API.")
+    parser.add_argument('--corpus', dest='corpus', choices=CORPORA + ("all",), default="all",
+                    help="Synthetic corpus to upload. (optional, default is all)")
+    parser.add_argument('--small-count', metavar='N', dest='small_count', type=int, default=500,
+                    help="Number of small JPEG files. (optional, default is 500)")
+    parser.add_argument('--small-size', metavar='KB', dest='small_size', type=int, default=300,
+                    help="Largest size of small files, sizes are random up to this. (optional, default is 300)")
+    parser.add_argument('--huge-count', metavar='N', dest='huge_count', type=int, default=3,
+                    help="Number of huge video files. (optional, default is 3)")
+    parser.add_argument('--huge-size', metavar='MB', dest='huge_size', type=int, default=256,
+                    help="Size of huge files. (optional, default is 256)")
+    parser.add_argument('--albums', metavar='N', dest='albums', type=int, default=4,
+                    help="Number of album folders files are spread over. (optional, default is 4)")
+    parser.add_argument('--jobs', metavar='N', dest='jobs', type=int, default=4,
+                    help="Passed to gphoto.py '--jobs'. (optional, default is 4)")
+    parser.add_argument('--latency', metavar='ms', dest='latency', type=float, default=20,
+                    help="Mock server response latency. (optional, default is 20)")
+    parser.add_argument('--bandwidth', metavar='MB/s', dest='bandwidth', type=float, default=0,
+                    help="Mock server upload bandwidth. (optional, default is 0, no limit)")
+    parser.add_argument('--page-size', metavar='N', dest='page_size', type=int, default=0,
+                    help="Mock server largest page size. (optional, default is 0, as requested)")
+    parser.add_argument('--error-rate', metavar='fraction', dest='error_rate', type=float, default=0,
+                    help="Fraction of requests failed with 429/503 by mock server. (optional, default is 0)")
+    parser.add_argument('--dir', metavar='work_dir', dest='work_dir',
+                    help="Folder for corpora and state, kept between runs. (optional, default is a temporary folder)")
+    parser.add_argument('--json', metavar='result_file', dest='result_file',
+                    help="Also write results to this file as JSON.")
+    parser.add_argument('gphoto_args', nargs='*',
+                    help="Extra arguments for gphoto.py, given after '--'.")
+    return parser.parse_args(arg_input)
+
+
+def write_file(path, size, block):
+    with open(path, 'wb') as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+# Create corpus folder (once), returns (root, file count, total bytes).
+def make_corpus(work_dir, name, args):
+    root = os.path.join(work_dir, name)
+    rnd = random.Random(name)
+    block = rnd.randbytes(1024 * 1024)
+    files = []
+
+    if name in ("small", "mixed"):
+        files += [("img_{:05d}.jpg".format(i), rnd.randint(10, args.small_size) * 1024) for i in range(args.small_count)]
+    if name in ("huge", "mixed"):
+        files += [("vid_{:03d}.mp4".format(i), args.huge_size * 1024 * 1024) for i in range(args.huge_count)]
+
+    for i, (file_name, size) in enumerate(files):
+        folder = os.path.join(root, "album_{:02d}".format(i % args.albums))
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, file_name)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            write_file(path, size, block)
+
+    return root, len(files), sum(size for _, size in files)
+
+
+def write_token(token_file):
+    expiry = datetime.utcnow() + timedelta(days=365)
+    with open(token_file, 'w') as f:
+        json.dump({"token": "benchmark", "refresh_token": "benchmark", "client_id": "benchmark",
+                   "client_secret": "benchmark", "expiry": expiry.isoformat() + "Z"}, f)
+
+
+# Upload corpus with gphoto.py, returns dict of measurements.
+def run(name, root, file_count, total_bytes, api_url, work_dir, args):
+    urllib.request.urlopen(api_url.replace("/v1", "/__reset")).read()
+
+    state_file = os.path.join(work_dir, "state_{}.db".format(name))
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(state_file + suffix):
+            os.remove(state_file + suffix)
+
+    token_file = os.path.join(work_dir, "token.json")
+    write_token(token_file)
+
+    command = [sys.executable, GPHOTO, "--up", "--path", root, "--token", token_file, "--state", state_file,
+               "--jobs", str(args.jobs), "--log", os.path.join(work_dir, "gphoto_{}.log".format(name))] + args.gphoto_args
+    env = dict(os.environ, GPHOTO_API_URL=api_url)
+
+    start = time.monotonic()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    stats = json.loads(urllib.request.urlopen(api_url.replace("/v1", "/__stats")).read())
+    uploaded = stats["media_items"]
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+    return {
+        "corpus": name,
+        "exit_code": process.returncode,
+        "files": file_count,
+        "uploaded": uploaded,
+        "megabytes": total_bytes / (1024 * 1024),
+        "seconds": elapsed,
+        "files_per_second": uploaded / elapsed,
+        "megabytes_per_second": stats["bytes_received"] / (1024 * 1024) / elapsed,
+        "api_calls": stats["total_calls"],
+        "api_calls_per_file": stats["total_calls"] / max(1, uploaded),
+        "calls": stats["calls"],
+        "injected_errors": stats["errors"],
+        "peak_rss_mb": peak_rss / (1024 * 1024)
+    }
+
+
+def print_results(results):
+    print("{:<8} | {:>9} | {:>9} | {:>8} | {:>8} | {:>7} | {:>10} | {:>8}".format(
+        "CORPUS", "FILES", "MB", "SECONDS", "FILES/S", "MB/S", "CALLS/FILE", "RSS MB"))
+    for r in results:
+        print("{:<8} | {:>9} | {:>9.1f} | {:>8.2f} | {:>8.1f} | {:>7.1f} | {:>10.2f} | {:>8.1f}".format(
+            r["corpus"], "{}/{}".format(r["uploaded"], r["files"]), r["megabytes"], r["seconds"],
+            r["files_per_second"], r["megabytes_per_second"], r["api_calls_per_file"], r["peak_rss_mb"]))
+        if r["exit_code"] != 0:
+            print("warning: gphoto.py exited with {}".format(r["exit_code"]))
+
+
+def main():
+    args = parse_args()
+    corpora = CORPORA if args.corpus == "all" else (args.corpus,)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="gphoto_benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+
+    server, _ = mock_server.start_server(latency=args.latency, bandwidth=args.bandwidth,
+                                         page_size=args.page_size, error_rate=args.error_rate, retry_after=0)
+    api_url = "http://127.0.0.1:{}/v1".format(server.server_port)
+
+    results = []
+    try:
+        for name in corpora:
+            root, file_count, total_bytes = make_corpus(work_dir, name, args)
+            results.append(run(name, root, file_count, total_bytes, api_url, work_dir, args))
+    finally:
+        server.shutdown()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results)
+
+    if args.result_file:
+        with open(args.result_file, 'w') as f:
+            json.dump({"options": {k: v for k, v in vars(args).items() if k != "result_file"}, "results": results}, f, indent=4)
+
+if __name__ == '__main__':
+  main()
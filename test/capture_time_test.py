@@ -0,0 +1,149 @@
+#capture_time_test
+#Checks of capture time header parsers of gphoto.py (EXIF in JPEG and TIFF,
+#Exif item of HEIF, 'mvhd' of MP4/QuickTime) against small files built here:
+#
+#   python test/capture_time_test.py
+#
+#Exits with 1 if any check fails.
+
+from datetime import datetime, timezone
+import os
+import os.path
+import shutil
+import struct
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gphoto
+
+ORIGINAL = "2019:07:14 10:20:30"
+MODIFIED = "2001:02:03 04:05:06"
+
+
+def parse(date):
+    return datetime.strptime(date, "%Y:%m:%d %H:%M:%S")
+
+
+# TIFF structure with DateTime in IFD0 and, if given, DateTimeOriginal in
+# Exif IFD. Order is '<' (II) or '>' (MM).
+def tiff(order, original=ORIGINAL, modified=MODIFIED):
+    magic = b"II*\x00" if order == "<" else b"MM\x00*"
+    entry = lambda tag, kind, length, value: struct.pack(order + "HHII", tag, kind, length, value)
+
+    ifd0_entries = 2 if original else 1
+    ifd0_size = 2 + 12 * ifd0_entries + 4
+    exif_ifd = 8 + ifd0_size
+    exif_size = 2 + 12 + 4 if original else 0
+    modified_offset = exif_ifd + exif_size
+    original_offset = modified_offset + 20
+
+    ifd0 = struct.pack(order + "H", ifd0_entries) + entry(0x0132, 2, 20, modified_offset)
+    if original:
+        ifd0 += entry(0x8769, 4, 1, exif_ifd)
+    ifd0 += struct.pack(order + "I", 0)
+
+    exif = struct.pack(order + "H", 1) + entry(0x9003, 2, 20, original_offset) + struct.pack(order + "I", 0) if original else b""
+
+    data = modified.encode() + b"\0"
+    if original:
+        data += original.encode() + b"\0"
+    return magic + struct.pack(order + "I", 8) + ifd0 + exif + data
+
+
+def segment(marker, payload):
+    return b"\xff" + bytes([marker]) + struct.pack(">H", 2 + len(payload)) + payload
+
+
+# JPEG with an APP0 segment before APP1 Exif one, so segments are skipped.
+def jpeg(exif=None):
+    data = b"\xff\xd8" + segment(0xE0, b"JFIF\0\1\1\0\0\1\0\1\0\0")
+    if exif is not None:
+        data += segment(0xE1, b"Exif\0\0" + exif)
+    return data + segment(0xDB, b"\0" * 65) + b"\xff\xda" + os.urandom(4096) + b"\xff\xd9"
+
+
+def box(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def full_box(kind, version, payload):
+    return box(kind, bytes([version, 0, 0, 0]) + payload)
+
+
+# HEIF with an image item and an Exif item stored in 'mdat', described by
+# 'iinf' of given version and 'iloc' of given version with base offset.
+def heif(iinf_version=0, iloc_version=1, base_offset=0):
+    exif_payload = struct.pack(">I", 6) + b"Exif\0\0" + tiff(">")
+    count = struct.pack(">H" if iinf_version == 0 else ">I", 2)
+    infe = lambda item_id, kind: full_box(b"infe", 2, struct.pack(">HH4s", item_id, 0, kind) + b"\0")
+    iinf = full_box(b"iinf", iinf_version, count + infe(1, b"hvc1") + infe(7, b"Exif"))
+
+    def build(exif_offset):
+        # offset_size 4, length_size 4, base_offset_size 4, index_size 0
+        items = b""
+        for item_id, offset, length in ((1, 0, 0), (7, exif_offset - base_offset, len(exif_payload))):
+            items += struct.pack(">H", item_id)
+            if iloc_version in (1, 2):
+                items += struct.pack(">H", 0)
+            items += struct.pack(">HIH", 0, base_offset, 1) + struct.pack(">II", offset, length)
+        iloc = full_box(b"iloc", iloc_version, bytes([0x44, 0x40]) + struct.pack(">H", 2) + items)
+        meta = full_box(b"meta", 0, full_box(b"hdlr", 0, b"\0" * 20) + iinf + iloc)
+        return box(b"ftyp", b"heic\0\0\0\0mif1heic") + meta
+
+    head = build(base_offset)
+    head = build(len(head) + 8)
+    return head + box(b"mdat", exif_payload)
+
+
+# MP4 with 'mvhd' of given version, 'moov' after a large 'mdat' box that uses
+# 64-bit size.
+def mp4(date, version=0):
+    seconds = int(parse(date).astimezone(timezone.utc).timestamp()) + gphoto.QUICKTIME_EPOCH
+    times = struct.pack(">QQ", seconds, seconds) if version == 1 else struct.pack(">II", seconds, seconds)
+    mvhd = full_box(b"mvhd", version, times + b"\0" * 80)
+    mdat = struct.pack(">I4sQ", 1, b"mdat", 16 + 1000) + b"\0" * 1000
+    return box(b"ftyp", b"isom\0\0\0\0isom") + mdat + box(b"moov", box(b"trak", b"\0" * 16) + mvhd)
+
+
+CASES = [
+    ("exif_big_endian.jpg", jpeg(tiff(">")), parse(ORIGINAL)),
+    ("exif_little_endian.jpg", jpeg(tiff("<")), parse(ORIGINAL)),
+    ("exif_datetime_only.jpg", jpeg(tiff("<", original=None)), parse(MODIFIED)),
+    ("no_exif.jpg", jpeg(), None),
+    ("bad_exif.jpg", jpeg(b"MM\0*" + b"\xff" * 30), None),
+    ("truncated.jpg", b"\xff\xd8\xff\xe1\xff\xff" + b"Exif\0\0MM\0*", None),
+    ("photo.tif", tiff("<"), parse(ORIGINAL)),
+    ("iinf0_iloc1.heic", heif(0, 1), parse(ORIGINAL)),
+    ("iinf1_iloc0.heic", heif(1, 0), parse(ORIGINAL)),
+    ("iloc_base_offset.heic", heif(0, 1, base_offset=16), parse(ORIGINAL)),
+    ("mvhd0.mp4", mp4(ORIGINAL, 0), parse(ORIGINAL)),
+    ("mvhd1.mov", mp4(ORIGINAL, 1), parse(ORIGINAL)),
+    ("empty.mp4", box(b"ftyp", b"isom\0\0\0\0isom"), None),
+    ("text.txt", b"not a photo", None),
+]
+
+
+def main():
+    folder = tempfile.mkdtemp(prefix="gphoto_capture_")
+    failed = 0
+    try:
+        for name, data, expected in CASES:
+            path = os.path.join(folder, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            result = gphoto.getCaptureTime(path)
+            status = "OK" if result == expected else "FAILED"
+            if result != expected:
+                failed += 1
+            print("{:<24} {:<6} {} (expected {})".format(name, status, result, expected))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if failed:
+        print("error: {} of {} checks failed".format(failed, len(CASES)))
+        sys.exit(1)
+    print("capture time test: OK")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,417 @@
+#mock_server
+#Local stand-in for the parts of Google Photos Library API used by gphoto.py.
+#Start it and point gphoto.py at it with GPHOTO_API_URL environment variable:
+#
+#   python test/mock_server.py --port 8765 --latency 50 --error-rate 0.02
+#   GPHOTO_API_URL=http://127.0.0.1:8765/v1 python gphoto.py --up --album x photo.jpg
+#
+#Latency, bandwidth, page size and injected 429/5xx errors are configurable.
+#Calls per endpoint and bytes received are served as JSON on /__stats.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+
+def parse_args(arg_input=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for Google Photos Library API.")
+    parser.add_argument('--host', dest='host', default='127.0.0.1',
+                    help="Address to listen on. (optional, default is 127.0.0.1)")
+    parser.add_argument('--port', dest='port', type=int, default=8765,
+                    help="Port to listen on. (optional, default is 8765)")
+    parser.add_argument('--latency', metavar='ms', dest='latency', type=float, default=0,
+                    help="Delay added to every response, in milliseconds. (optional, default is 0)")
+    parser.add_argument('--bandwidth', metavar='MB/s', dest='bandwidth', type=float, default=0,
+                    help="Upload bandwidth shared by all connections. (optional, default is 0, no limit)")
+    parser.add_argument('--page-size', metavar='N', dest='page_size', type=int, default=0,
+                    help="Maximum page size of album and media item listings. (optional, default is 0, as requested)")
+    parser.add_argument('--error-rate', metavar='fraction', dest='error_rate', type=float, default=0,
+                    help="Fraction of requests failed with one of '--error-codes'. (optional, default is 0)")
+    parser.add_argument('--error-codes', metavar='codes', dest='error_codes', default='429,503',
+                    help="Comma separated status codes of injected errors. (optional, default is 429,503)")
+    parser.add_argument('--retry-after', metavar='seconds', dest='retry_after', type=int, default=None,
+                    help="Retry-After header sent with injected errors. (optional, default is none)")
+    return parser.parse_args(arg_input)
+
+
+# Shared upload link, callers sleep so that total rate stays under bytes_per_second.
+class Link:
+
+    def __init__(self, bytes_per_second):
+        self.lock = threading.Lock()
+        self.bytes_per_second = bytes_per_second
+        self.free_at = time.monotonic()
+
+    def transfer(self, count):
+        if not self.bytes_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.free_at = max(self.free_at, now) + count / self.bytes_per_second
+            delay = self.free_at - now
+        time.sleep(delay)
+
+
+# In-memory library and request counters.
+class MockLibrary:
+
+    def __init__(self, latency=0, bandwidth=0, page_size=0, error_rate=0, error_codes=(429, 503), retry_after=None):
+        self.lock = threading.Lock()
+        self.latency = latency / 1000.0
+        self.link = Link(bandwidth * 1024 * 1024)
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.retry_after = retry_after
+        self.ids = itertools.count(1)
+
+        self.albums = {}
+        self.media_items = {}
+        self.sizes = {}
+        self.uploads = {}
+        self.sessions = {}
+
+        self.calls = {}
+        self.errors = 0
+        self.bytes_received = 0
+
+    def next_id(self, prefix):
+        with self.lock:
+            return "{}{}".format(prefix, next(self.ids))
+
+    def count(self, endpoint, received=0):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            self.bytes_received += received
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "total_calls": sum(self.calls.values()),
+                "errors": self.errors,
+                "bytes_received": self.bytes_received,
+                "albums": len(self.albums),
+                "media_items": len(self.media_items)
+            }
+
+    def reset(self):
+        with self.lock:
+            self.albums.clear()
+            self.media_items.clear()
+            self.sizes.clear()
+            self.uploads.clear()
+            self.sessions.clear()
+            self.calls.clear()
+            self.errors = 0
+            self.bytes_received = 0
+
+    def inject_error(self):
+        if self.error_rate and random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            return random.choice(self.error_codes)
+        return None
+
+    def page(self, items, params, key):
+        page_size = int(params.get("pageSize", 0) or 0) or 25
+        if self.page_size:
+            page_size = min(page_size, self.page_size)
+        start = int(params.get("pageToken", 0) or 0)
+        result = {key: items[start:start + page_size]} if items[start:start + page_size] else {}
+        if start + page_size < len(items):
+            result["nextPageToken"] = str(start + page_size)
+        return result
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    library = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code, body, headers=None):
+        self.send_body(code, json.dumps(body).encode(), "application/json", headers)
+
+    def send_body(self, code, body, content_type="text/plain", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        remaining = int(self.headers.get("Content-Length", 0))
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            self.library.link.transfer(len(chunk))
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
+
+    def handle_request(self, method):
+        library = self.library
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = self.read_body()
+        path = url.path
+
+        if path == "/__stats":
+            return self.send_json(200, library.stats())
+        if path == "/__reset":
+            library.reset()
+            return self.send_json(200, {})
+
+        endpoint = "{} {}".format(method, re.sub(r"/(uploads|mediaItems|albums|download)/[^/:]+", r"/\1/{id}", path))
+        library.count(endpoint, len(body))
+
+        if library.latency:
+            time.sleep(library.latency)
+
+        error = library.inject_error()
+        if error:
+            headers = {"Retry-After": str(library.retry_after)} if library.retry_after is not None else {}
+            return self.send_json(error, {"error": {"code": error, "status": "UNAVAILABLE", "message": "Injected error"}}, headers)
+
+        if path == "/v1/albums" and method == "GET":
+            return self.list_albums(params)
+        if path == "/v1/albums" and method == "POST":
+            return self.create_album(body)
+        if path == "/v1/uploads" and method == "POST":
+            return self.upload(body)
+        if path.startswith("/v1/uploads/") and method == "POST":
+            return self.upload_chunk(path.rsplit("/", 1)[1], body)
+        if path.startswith("/v1/albums/") and path.endswith(":batchAddMediaItems") and method == "POST":
+            return self.batch_add(path[len("/v1/albums/"):-len(":batchAddMediaItems")], body)
+        if path == "/v1/mediaItems:batchCreate" and method == "POST":
+            return self.batch_create(body)
+        if path == "/v1/mediaItems:search" and method == "POST":
+            return self.search(params, body)
+        if path.startswith("/download/") and method == "GET":
+            return self.download(path.rsplit("/", 1)[1].split("=")[0])
+        if path.startswith("/v1/mediaItems/") and method == "GET":
+            return self.get_media_item(path.rsplit("/", 1)[1])
+        if path.startswith("/v1/mediaItems/") and method == "PATCH":
+            return self.patch_media_item(path.rsplit("/", 1)[1], body)
+
+        self.send_json(404, {"error": {"code": 404, "status": "NOT_FOUND", "message": "No such endpoint"}})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def list_albums(self, params):
+        with self.library.lock:
+            albums = list(self.library.albums.values())
+        if params.get("excludeNonAppCreatedData") in ("True", "true"):
+            albums = [a for a in albums if a["isWriteable"]]
+        albums = [{k: v for k, v in a.items() if k != "items"} for a in albums]
+        self.send_json(200, self.library.page(albums, params, "albums"))
+
+    def create_album(self, body):
+        title = json.loads(body)["album"]["title"]
+        album_id = self.library.next_id("album")
+        album = {"id": album_id, "title": title, "isWriteable": True, "mediaItemsCount": "0",
+                 "productUrl": "http://mock/album/" + album_id, "items": []}
+        with self.library.lock:
+            self.library.albums[album_id] = album
+        self.send_json(200, {k: v for k, v in album.items() if k != "items"})
+
+    def upload(self, body):
+        command = self.headers.get("X-Goog-Upload-Command")
+        file_name = self.headers.get("X-Goog-Upload-File-Name", "")
+
+        if command == "start":
+            session_id = self.library.next_id("session")
+            with self.library.lock:
+                self.library.sessions[session_id] = {"file_name": file_name, "received": 0,
+                                                     "size": int(self.headers.get("X-Goog-Upload-Raw-Size", 0))}
+            host = self.headers.get("Host")
+            return self.send_body(200, b"", headers={
+                "X-Goog-Upload-URL": "http://{}/v1/uploads/{}".format(host, session_id),
+                "X-Goog-Upload-Chunk-Granularity": str(256 * 1024),
+                "X-Goog-Upload-Status": "active"
+            })
+
+        token = self.library.next_id("token")
+        with self.library.lock:
+            self.library.uploads[token] = {"file_name": file_name, "size": len(body)}
+        self.send_body(200, token.encode())
+
+    def upload_chunk(self, session_id, body):
+        command = self.headers.get("X-Goog-Upload-Command", "")
+        with self.library.lock:
+            session = self.library.sessions.get(session_id)
+        if session is None:
+            return self.send_body(404, b"", headers={"X-Goog-Upload-Status": "final"})
+
+        if command == "query":
+            return self.send_body(200, b"", headers={"X-Goog-Upload-Status": "active",
+                                                     "X-Goog-Upload-Size-Received": str(session["received"])})
+
+        offset = int(self.headers.get("X-Goog-Upload-Offset", -1))
+        if offset != session["received"]:
+            return self.send_body(400, b"Wrong offset", headers={"X-Goog-Upload-Status": "active"})
+        session["received"] += len(body)
+
+        if "finalize" not in command:
+            return self.send_body(200, b"", headers={"X-Goog-Upload-Status": "active"})
+
+        token = self.library.next_id("token")
+        with self.library.lock:
+            del self.library.sessions[session_id]
+            self.library.uploads[token] = {"file_name": session["file_name"], "size": session["received"]}
+        self.send_body(200, token.encode(), headers={"X-Goog-Upload-Status": "final"})
+
+    def batch_create(self, body):
+        request = json.loads(body)
+        album = self.library.albums.get(request.get("albumId"))
+        results = []
+
+        for new_item in request["newMediaItems"]:
+            token = new_item["simpleMediaItem"]["uploadToken"]
+            with self.library.lock:
+                upload = self.library.uploads.pop(token, None)
+            if upload is None:
+                results.append({"uploadToken": token, "status": {"code": 3, "message": "Invalid upload token"}})
+                continue
+
+            media_id = self.library.next_id("media")
+            file_name = upload["file_name"] or media_id
+            media_item = {"id": media_id, "filename": file_name, "description": new_item.get("description", ""),
+                          "productUrl": "http://mock/photo/" + media_id,
+                          "baseUrl": "http://{}/download/{}".format(self.headers.get("Host"), media_id),
+                          "mimeType": "application/octet-stream", "mediaMetadata": {"creationTime": "2020-01-01T00:00:00Z"}}
+            with self.library.lock:
+                self.library.media_items[media_id] = media_item
+                self.library.sizes[media_id] = upload["size"]
+                if album is not None:
+                    album["items"].append(media_id)
+                    album["mediaItemsCount"] = str(len(album["items"]))
+            results.append({"uploadToken": token, "status": {"message": "Success"}, "mediaItem": media_item})
+
+        self.send_json(200, {"newMediaItemResults": results})
+
+    def batch_add(self, album_id, body):
+        media_ids = json.loads(body).get("mediaItemIds", [])
+        with self.library.lock:
+            album = self.library.albums.get(album_id)
+            if album is None:
+                return self.send_json(404, {"error": {"code": 404, "status": "NOT_FOUND", "message": "No such album"}})
+            if not media_ids or len(media_ids) > 50 or any(i not in self.library.media_items for i in media_ids):
+                return self.send_json(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT", "message": "Invalid media items"}})
+            album["items"] += [i for i in media_ids if i not in album["items"]]
+            album["mediaItemsCount"] = str(len(album["items"]))
+        self.send_json(200, {})
+
+    def search(self, params, body):
+        if body:
+            params = dict(params, **json.loads(body))
+        with self.library.lock:
+            album = self.library.albums.get(params.get("albumId"))
+            if album is not None:
+                items = [self.library.media_items[i] for i in album["items"]]
+            else:
+                items = list(self.library.media_items.values())
+        self.send_json(200, self.library.page(items, params, "mediaItems"))
+
+    def get_media_item(self, media_id):
+        with self.library.lock:
+            media_item = self.library.media_items.get(media_id)
+        if media_item is None:
+            return self.send_json(404, {"error": {"code": 404, "status": "NOT_FOUND", "message": "No such media item"}})
+        self.send_json(200, media_item)
+
+    # Content of a media item is its id repeated up to size it was uploaded
+    # with. Supports 'Range: bytes=N-' requests.
+    def download(self, media_id):
+        with self.library.lock:
+            size = self.library.sizes.get(media_id)
+        if size is None:
+            return self.send_body(404, b"No such media item")
+
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        start = int(match.group(1)) if match else 0
+        if start >= size and match:
+            return self.send_body(416, b"", headers={"Content-Range": "bytes */{}".format(size)})
+
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size - start))
+        if match:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, size - 1, size))
+        self.end_headers()
+
+        pattern = (media_id + "|").encode()
+        block = pattern * (1024 * 1024 // len(pattern) + 1)
+        offset = start
+        while offset < size:
+            # Start block at offset's place in pattern, so content doesn't depend on range.
+            shift = offset % len(pattern)
+            chunk = block[shift:shift + min(1024 * 1024 - len(pattern), size - offset)]
+            self.library.link.transfer(len(chunk))
+            try:
+                self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # Client stopped reading, e.g. its Range request was a probe.
+                self.close_connection = True
+                return
+            offset += len(chunk)
+
+    def patch_media_item(self, media_id, body):
+        with self.library.lock:
+            media_item = self.library.media_items.get(media_id)
+            if media_item is not None:
+                media_item.update(json.loads(body))
+        if media_item is None:
+            return self.send_json(404, {"error": {"code": 404, "status": "NOT_FOUND", "message": "No such media item"}})
+        self.send_json(200, media_item)
+
+
+def make_server(host, port, library):
+    handler = type("BoundHandler", (Handler,), {"library": library})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+# Start server on a background thread, returns (server, library). API base URL
+# is "http://host:port/v1", with port taken from server.server_port.
+def start_server(host='127.0.0.1', port=0, **library_options):
+    library = MockLibrary(**library_options)
+    server = make_server(host, port, library)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, library
+
+
+def main():
+    args = parse_args()
+    library = MockLibrary(args.latency, args.bandwidth, args.page_size, args.error_rate,
+                          [int(c) for c in args.error_codes.split(',') if c], args.retry_after)
+    server = make_server(args.host, args.port, library)
+    print("Mock Google Photos API at http://{}:{}/v1".format(args.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,69 @@
+#progress_test
+#Checks of progress line of gphoto.py (Progress.status) for runs with and
+#without files found by scan, including ones where nothing is sent at all:
+#
+#   python test/progress_test.py
+#
+#Exits with 1 if any check fails.
+
+import os
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gphoto
+
+MEGABYTE = 1024 * 1024
+
+
+def progress(total=(), done=(), sent=0, seconds=0):
+    p = gphoto.Progress()
+    for size in total:
+        p.add_total(size)
+    if seconds:
+        p.samples.append((time.monotonic() - seconds, 0))
+    if sent:
+        p.sent(sent)
+    for size in done:
+        p.file_done(size)
+    return p
+
+
+def counts(*args):
+    p = gphoto.Progress()
+    p.set_counts(*args)
+    return p
+
+
+CASES = [
+    # Nothing found by scan, e.g. upload from stdin.
+    ("no_total", progress(done=[MEGABYTE]), "Files: 1 done; 1.0 MB; 0.00 MB/s"),
+    # All files were uploaded before, nothing sent in this run.
+    ("all_skipped", progress(total=[MEGABYTE, MEGABYTE], done=[MEGABYTE, MEGABYTE]), "ETA 0:00:00"),
+    ("empty_files", progress(total=[0, 0], done=[0, 0]), "Files: 2/2; 0.0/0.0 MB (100%); 0.00 MB/s; ETA 0:00:00"),
+    ("workers_all_done", counts(3, 3 * MEGABYTE, 3, 3 * MEGABYTE), "Files: 3/3; 3.0/3.0 MB (100%); 0.00 MB/s; ETA 0:00:00"),
+    ("no_rate_yet", progress(total=[MEGABYTE, MEGABYTE]), "ETA -:--:--"),
+    ("rate", progress(total=[10 * MEGABYTE, 10 * MEGABYTE], done=[10 * MEGABYTE], sent=10 * MEGABYTE, seconds=10), "ETA 0:00:1"),
+]
+
+
+def main():
+    failed = 0
+    for name, p, expected in CASES:
+        try:
+            result = p.status()
+        except Exception as err:
+            result = "{}: {}".format(type(err).__name__, err)
+        status = "OK" if expected in result else "FAILED"
+        if status != "OK":
+            failed += 1
+        print("{:<20} {:<6} {} (expected {})".format(name, status, result, expected))
+
+    if failed:
+        print("error: {} of {} checks failed".format(failed, len(CASES)))
+        sys.exit(1)
+    print("progress test: OK")
+
+if __name__ == '__main__':
+  main()
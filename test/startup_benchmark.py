@@ -0,0 +1,149 @@
+#startup_benchmark
+#Startup cost of gphoto.py, for runs that upload one file per process.
+#Reports import time of gphoto module (with its slowest direct imports) and
+#wall time of 'gphoto.py -h', then uploads the same files to
+#test/mock_server.py once with a process per file and once as a single
+#'--up --from-stdin' run:
+#
+#   python test/startup_benchmark.py --files 20 --max-import-ms 250
+#
+#With '--max-import-ms' it exits with 1 when import takes longer, so import
+#time can be checked in CI and doesn't creep back up.
+
+import argparse
+import json
+import os
+import os.path
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmark
+import mock_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GPHOTO = os.path.join(ROOT, "gphoto.py")
+IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def parse_args(arg_input=None):
+    parser = argparse.ArgumentParser(description="Benchmark gphoto.py startup and per-file process cost.")
+    parser.add_argument('--runs', metavar='N', dest='runs', type=int, default=5,
+                    help="Number of runs to take median import time from. (optional, default is 5)")
+    parser.add_argument('--files', metavar='N', dest='files', type=int, default=20,
+                    help="Number of files uploaded per mode, 0 to skip uploads. (optional, default is 20)")
+    parser.add_argument('--latency', metavar='ms', dest='latency', type=float, default=20,
+                    help="Mock server response latency. (optional, default is 20)")
+    parser.add_argument('--max-import-ms', metavar='ms', dest='max_import_ms', type=float, default=0,
+                    help="Exit with 1 if median import time is above this. (optional, default is 0, no limit)")
+    parser.add_argument('--json', metavar='result_file', dest='result_file',
+                    help="Also write results to this file as JSON.")
+    return parser.parse_args(arg_input)
+
+
+# Returns (total import time of gphoto, {direct import: time}) in ms, from
+# output of 'python -X importtime'.
+def import_time():
+    command = [sys.executable, "-X", "importtime", "-c", "import gphoto"]
+    output = subprocess.run(command, cwd=ROOT, capture_output=True, text=True, check=True).stderr
+
+    total = 0
+    children = {}
+    for line in output.splitlines():
+        match = IMPORT_TIME.match(line)
+        if not match:
+            continue
+        cumulative, depth, name = int(match.group(2)) / 1000.0, len(match.group(3)), match.group(4)
+        if name == "gphoto" and depth == 1:
+            total = cumulative
+        elif depth == 3:
+            children[name] = cumulative
+    return total, children
+
+
+def wall_time(command, **kwargs):
+    start = time.monotonic()
+    subprocess.run(command, stdout=subprocess.DEVNULL, check=True, **kwargs)
+    return time.monotonic() - start
+
+
+# Upload files with a process per file and with one '--from-stdin' process,
+# returns seconds taken by each.
+def compare_uploads(args, work_dir):
+    server, _ = mock_server.start_server(latency=args.latency)
+    api_url = "http://127.0.0.1:{}/v1".format(server.server_port)
+    env = dict(os.environ, GPHOTO_API_URL=api_url)
+
+    token_file = os.path.join(work_dir, "token.json")
+    benchmark.write_token(token_file)
+
+    files = []
+    for i in range(args.files):
+        path = os.path.join(work_dir, "img_{:04d}.jpg".format(i))
+        benchmark.write_file(path, 64 * 1024, os.urandom(64 * 1024))
+        files.append(path)
+
+    def command(mode):
+        return [sys.executable, GPHOTO, "--up", "--token", token_file, "--state", os.path.join(work_dir, mode + ".db"),
+                "--log", os.path.join(work_dir, "gphoto.log")]
+
+    try:
+        start = time.monotonic()
+        for path in files:
+            subprocess.run(command("per_file") + ["--album", "startup", path], env=env, stdout=subprocess.DEVNULL, check=True)
+        per_file = time.monotonic() - start
+
+        records = b"".join(b"startup\t" + os.fsencode(path) + b"\0" for path in files)
+        start = time.monotonic()
+        subprocess.run(command("stdin") + ["--from-stdin"], input=records, env=env, stdout=subprocess.DEVNULL, check=True)
+        stdin = time.monotonic() - start
+
+        uploaded = json.loads(urllib.request.urlopen(api_url.replace("/v1", "/__stats")).read())["media_items"]
+    finally:
+        server.shutdown()
+
+    return {"per_file_seconds": per_file, "stdin_seconds": stdin, "uploaded": uploaded}
+
+
+def main():
+    args = parse_args()
+
+    runs = [import_time() for _ in range(args.runs)]
+    import_ms = statistics.median(total for total, _ in runs)
+    children = runs[-1][1]
+    help_seconds = statistics.median(wall_time([sys.executable, GPHOTO, "-h"]) for _ in range(args.runs))
+
+    print("Import gphoto:      {:8.1f} ms (median of {})".format(import_ms, args.runs))
+    for name, ms in sorted(children.items(), key=lambda c: -c[1])[:8]:
+        print("  {:<30} {:8.1f} ms".format(name, ms))
+    print("gphoto.py -h:       {:8.1f} ms".format(help_seconds * 1000))
+
+    results = {"import_ms": import_ms, "imports_ms": children, "help_ms": help_seconds * 1000}
+
+    if args.files > 0:
+        work_dir = tempfile.mkdtemp(prefix="gphoto_startup_")
+        try:
+            results.update(compare_uploads(args, work_dir))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        print("{} files, process per file: {:8.2f} s ({:.0f} ms per file)".format(
+            args.files, results["per_file_seconds"], results["per_file_seconds"] * 1000 / args.files))
+        print("{} files, --from-stdin:     {:8.2f} s ({:.0f} ms per file)".format(
+            args.files, results["stdin_seconds"], results["stdin_seconds"] * 1000 / args.files))
+
+    if args.result_file:
+        with open(args.result_file, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.max_import_ms and import_ms > args.max_import_ms:
+        print("error: import takes {:.1f} ms, more than {:.1f} ms".format(import_ms, args.max_import_ms))
+        sys.exit(1)
+
+if __name__ == '__main__':
+  main()
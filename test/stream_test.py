@@ -0,0 +1,109 @@
+#stream_test
+#Checks that uploads of more files than are grouped in one batch
+#(STREAM_BATCH_SIZE) lose none of them, for records of '--from-stdin' and for
+#GPhotoClient, against test/mock_server.py:
+#
+#   python test/stream_test.py
+#
+#Exits with 1 if any check fails.
+
+import os
+import os.path
+import queue
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmark
+import mock_server
+
+server, library = mock_server.start_server()
+os.environ["GPHOTO_API_URL"] = "http://127.0.0.1:{}/v1".format(server.server_port)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gphoto
+
+
+def make_files(folder, count):
+    files = []
+    for i in range(count):
+        path = os.path.join(folder, "f{:05}.jpg".format(i))
+        with open(path, 'wb') as f:
+            f.write(i.to_bytes(4, "big"))
+        files.append(path)
+    return files
+
+
+def uploaded():
+    with library.lock:
+        return sorted(m["filename"] for m in library.media_items.values())
+
+
+# Records of two full batches and a part of third one, all queued before
+# upload starts, as when stdin is read faster than files are uploaded.
+def check_records(folder, token_file):
+    files = make_files(folder, 2 * gphoto.STREAM_BATCH_SIZE + 500)
+    records = queue.Queue()
+    for path in files:
+        records.put(("Stream", path))
+    records.put(None)
+
+    session = gphoto.get_authorized_session(None, token_file)
+    state = gphoto.UploadState(":memory:")
+    try:
+        result = gphoto.uploadRecords(session, records, jobs=8, state=state)
+    finally:
+        state.close()
+    missing = sorted(set(os.path.basename(path) for path in files) - set(uploaded()))
+    if not result or missing:
+        return "result {}, {} of {} files missing, e.g. {}".format(result, len(missing), len(files), missing[:3])
+
+
+# One batch of more files than STREAM_BATCH_SIZE, every result is resolved.
+def check_client(folder, token_file):
+    files = make_files(folder, gphoto.STREAM_BATCH_SIZE + 100)
+    with gphoto.GPhotoClient(token_file, jobs=8) as client:
+        future = client.submit(files, "Client")
+        try:
+            results = future.result(timeout=300)
+        except Exception as err:
+            return "{}: {}".format(type(err).__name__, err)
+        if client.pending:
+            return "{} files still pending".format(len(client.pending))
+    failed = [r["file"] for r in results if r["result"] != "uploaded"]
+    if len(results) != len(files) or failed:
+        return "{} results for {} files, {} not uploaded".format(len(results), len(files), len(failed))
+
+
+CHECKS = [
+    ("records", check_records),
+    ("client", check_client),
+]
+
+
+def main():
+    work_dir = tempfile.mkdtemp(prefix="gphoto_stream_")
+    token_file = os.path.join(work_dir, "token.json")
+    benchmark.write_token(token_file)
+    failed = 0
+    try:
+        for name, check in CHECKS:
+            library.reset()
+            folder = os.path.join(work_dir, name)
+            os.makedirs(folder)
+            error = check(folder, token_file)
+            if error:
+                failed += 1
+            print("{:<12} {}".format(name, "FAILED -- " + error if error else "OK"))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        server.shutdown()
+
+    if failed:
+        print("error: {} of {} checks failed".format(failed, len(CHECKS)))
+        sys.exit(1)
+    print("stream test: OK")
+
+if __name__ == '__main__':
+  main()